@@ -0,0 +1,95 @@
+import sys
+from array import array
+
+#this file converts annotations between YOLO text lines and the packed binary form they are stored in.
+#each box is 5 little endian float32 values (class, x centre, y centre, width, height), boxes are stored back to back
+
+BOX_FIELDS = 5
+
+
+# raised when an annotation does not hold valid YOLO boxes
+class InvalidAnnotationError(ValueError):
+    pass
+
+
+# parses YOLO text lines into a flat array of box values, validating every box
+# param: lines: list of "class x y w h" strings
+# param: class_count: number of classes annotated for, class indexes must be below it
+# return: array('f') of 5 values per box
+def parse_yolo_lines(lines, class_count):
+    if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        raise InvalidAnnotationError("Annotation must be a list of \"class x y w h\" strings")
+    values = array("f")
+    for line_number, line in enumerate(lines, start=1):
+        fields = line.split()
+        if not fields:
+            continue
+        if len(fields) != BOX_FIELDS:
+            raise InvalidAnnotationError(f"Line {line_number} has {len(fields)} fields, expected {BOX_FIELDS}")
+        try:
+            class_index = int(fields[0])
+            x, y, w, h = (float(field) for field in fields[1:])
+        except ValueError:
+            raise InvalidAnnotationError(f"Line {line_number} is not numeric: {line!r}")
+
+        if not 0 <= class_index < class_count:
+            raise InvalidAnnotationError(f"Line {line_number} has class {class_index}, expected 0 to {class_count - 1}")
+        if not (0 <= x <= 1 and 0 <= y <= 1 and 0 < w <= 1 and 0 < h <= 1):
+            raise InvalidAnnotationError(f"Line {line_number} has a box outside the normalised 0-1 range: {line!r}")
+
+        values.extend((class_index, x, y, w, h))
+    return values
+
+
+# packs box values into bytes for storing as BSON binary
+# param: values: array('f') from parse_yolo_lines, or any sequence of numbers
+# return: bytes
+def pack_boxes(values):
+    if not isinstance(values, array) or values.typecode != "f":
+        values = array("f", values)
+    return values.tobytes() if sys.byteorder == "little" else _swapped(values).tobytes()
+
+
+# unpacks stored bytes into box values
+# param: data: bytes from pack_boxes
+# return: array('f') of 5 values per box
+def unpack_boxes(data):
+    values = array("f")
+    values.frombytes(bytes(data))
+    return values if sys.byteorder == "little" else _swapped(values)
+
+
+# formats packed boxes as the contents of a YOLO label file
+# param: data: bytes from pack_boxes
+# return: label file text, one "class x y w h" line per box
+def to_yolo_text(data):
+    values = unpack_boxes(data)
+    lines = []
+    for i in range(0, len(values), BOX_FIELDS):
+        c, x, y, w, h = values[i:i + BOX_FIELDS]
+        lines.append(f"{int(c)} {x:.6f} {y:.6f} {w:.6f} {h:.6f}\n")
+    return "".join(lines)
+
+
+# gets the YOLO label file text of an annotation document in either the packed or the older text line layout
+# param: annotation: annotation document with "boxes" or "annotation"
+# return: label file text
+def annotation_text(annotation):
+    if "boxes" in annotation:
+        return to_yolo_text(annotation["boxes"])
+    return "".join(line+"\n" for line in annotation.get("annotation", []))
+
+
+# gets the YOLO text lines of an annotation document, the layout the API has always returned
+# param: annotation: annotation document with "boxes" or "annotation"
+# return: list of "class x y w h" strings
+def annotation_lines(annotation):
+    if "boxes" in annotation:
+        return to_yolo_text(annotation["boxes"]).splitlines()
+    return annotation.get("annotation", [])
+
+
+def _swapped(values):
+    values = array("f", values)
+    values.byteswap()
+    return values
@@ -0,0 +1,89 @@
+import asyncio
+import functools
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from config import MONGO_MAX_POOL_SIZE
+import db
+
+#this file is the async version of db.py for the API handlers. Every function here has the same name, arguments
+#and result as in db.py but runs on a thread pool sized to the MongoDB connection pool, so a slow query never
+#blocks the event loop and concurrent requests each get their own connection.
+#results that are cursors are read into lists on the pool thread, iterating them later would block the loop
+
+_executor = ThreadPoolExecutor(max_workers=MONGO_MAX_POOL_SIZE, thread_name_prefix="db")
+
+# functions of db.py that talk to MongoDB, pure helpers (generate_id, geo_point, ...) are used from db directly
+FUNCTIONS = [
+    "dynamic_find",
+    "id_find",
+    "ensure_indexes",
+    "get_index_names",
+    "explain_find",
+    "insert_image_metadata",
+    "insert_many_image_metadata",
+    "backfill_locations",
+    "get_photo_by_hash",
+    "get_photos_missing_hash",
+    "set_photo_hash",
+    "find_duplicate_photos",
+    "merge_duplicate_photos",
+    "get_photos",
+    "get_photo_paths",
+    "get_photos_missing_variants",
+    "set_photo_variants",
+    "create_dataset",
+    "dataset_name_exists",
+    "get_dataset_from_name",
+    "get_all_dataset_names",
+    "remove_photo_from_dataset",
+    "remove_photos_from_dataset",
+    "get_dataset_from_id",
+    "get_dataset_with_photos",
+    "get_dataset_metadata",
+    "add_dataset_photos",
+    "get_dataset_photo_ids",
+    "get_dataset_photo_page",
+    "migrate_dataset_membership",
+    "get_unmigrated_dataset_ids",
+    "save_annotations",
+    "save_annotations_bulk",
+    "get_annotations_for_photo",
+    "get_annotations_for_photos",
+    "get_annotation_versions",
+    "find_matching_annotations",
+    "migrate_annotation_encoding",
+    "migrate_annotation_keys",
+    "save_model",
+    "save_model_path",
+    "model_exists",
+    "get_all_models",
+    "get_model_path",
+    "model_name_exists",
+]
+
+
+# runs a blocking db function on the database thread pool
+# param: func: function to run
+# return: its result, with cursors and other iterators read into a list
+async def run(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(call, func, args, kwargs))
+
+
+def call(func, args, kwargs):
+    result = func(*args, **kwargs)
+    if isinstance(result, Iterator):
+        result = list(result)
+    return result
+
+
+# wraps a db function as a coroutine function of the same name
+def make_async(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await run(func, *args, **kwargs)
+    return wrapper
+
+
+for _name in FUNCTIONS:
+    globals()[_name] = make_async(getattr(db, _name))
@@ -0,0 +1,126 @@
+from config import DATASET_JOB_WORKERS, FINISHED_JOB_TTL_SECONDS
+from concurrent.futures import ThreadPoolExecutor
+import db
+import threading
+import time
+
+#this file runs long dataset work such as loads on a worker pool, off the event loop,
+#and keeps the status and progress of each job so the API can report it
+
+
+# raised inside a job's progress callback once the job has been cancelled
+class JobCancelled(Exception):
+    pass
+
+
+_executor = ThreadPoolExecutor(max_workers=DATASET_JOB_WORKERS, thread_name_prefix="dataset-job")
+_jobs = {}
+_cancel_events = {}
+_futures = {}
+_jobs_lock = threading.Lock()
+
+
+# submits a function to run as a background job
+# param: kind: short name of the work e.g. "load_dataset"
+# param: func: function called as func(job_id, progress_callback), its return value becomes the job result
+# return: (job id, concurrent.futures.Future of the result)
+def submit_job(kind, func):
+    prune_jobs()
+
+    job_id = db.generate_id()
+    with _jobs_lock:
+        _jobs[job_id] = {
+            "id": job_id,
+            "kind": kind,
+            "status": "queued",
+            "stage": None,
+            "done": 0,
+            "total": 0,
+            "percent": 0.0,
+            "result": None,
+            "error": None,
+            "created_at": time.time(),
+            "finished_at": None,
+        }
+        _cancel_events[job_id] = threading.Event()
+        future = _executor.submit(_run_job, job_id, func)
+        _futures[job_id] = future
+    return job_id, future
+
+
+# runs a job's function, recording its status as it goes
+def _run_job(job_id, func):
+    if _cancel_events[job_id].is_set():
+        _finish_job(job_id, "cancelled")
+        raise JobCancelled(job_id)
+    _update_job(job_id, status="running")
+
+    try:
+        result = func(job_id, lambda stage, done, total: report_progress(job_id, stage, done, total))
+    except JobCancelled:
+        _finish_job(job_id, "cancelled")
+        raise
+    except Exception as e:
+        _finish_job(job_id, "failed", error=str(e))
+        raise
+
+    _finish_job(job_id, "done", result=result)
+    return result
+
+
+# records the progress of a job, raises JobCancelled if the job has been cancelled
+# param: job_id: id of the job
+# param: stage: name of the current stage e.g. "images/train"
+# param: done: items of the stage completed so far
+# param: total: items in the stage
+def report_progress(job_id, stage, done, total):
+    if _cancel_events[job_id].is_set():
+        raise JobCancelled(job_id)
+    percent = (done / total) * 100 if total else 100.0
+    _update_job(job_id, stage=stage, done=done, total=total, percent=round(percent, 2))
+
+
+# returns the status of a job
+# param: job_id: id of the job
+# return: copy of the job status dict, None if no such job
+def get_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        return dict(job) if job is not None else None
+
+
+# requests cancellation of a job, queued jobs never start and running jobs stop at their next progress report
+# param: job_id: id of the job
+# return: False if there is no such job or it has already finished
+def cancel_job(job_id):
+    with _jobs_lock:
+        job = _jobs.get(job_id)
+        if job is None or job["finished_at"] is not None:
+            return False
+        _cancel_events[job_id].set()
+        if _futures[job_id].cancel():
+            # never started so _run_job will not record it
+            job["status"] = "cancelled"
+            job["finished_at"] = time.time()
+    return True
+
+
+# forgets jobs that finished more than FINISHED_JOB_TTL_SECONDS ago
+def prune_jobs():
+    now = time.time()
+    with _jobs_lock:
+        expired = [job_id for job_id, job in _jobs.items()
+                   if job["finished_at"] is not None and now - job["finished_at"] > FINISHED_JOB_TTL_SECONDS]
+        for job_id in expired:
+            del _jobs[job_id]
+            del _cancel_events[job_id]
+            del _futures[job_id]
+
+
+def _update_job(job_id, **fields):
+    with _jobs_lock:
+        _jobs[job_id].update(fields)
+
+
+def _finish_job(job_id, status, result=None, error=None):
+    _update_job(job_id, status=status, result=result, error=error, finished_at=time.time())
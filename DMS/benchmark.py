@@ -0,0 +1,348 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+from types import SimpleNamespace
+import config
+
+#benchmarks the hot paths of the DMS (image upload, annotations, dataset creation and loading) on synthetic data
+#at several data sizes, so regressions show up between releases. Everything runs against a throwaway database
+#and a temp folder, the configured image store and database are never touched.
+#usage: python benchmark.py [--sizes 100 1000 10000] [--mongomock] [--output results.json]
+#
+#results are written as JSON, one entry per (size, stage) with throughput, latency percentiles and the peak
+#memory allocated by Python during the stage (tracemalloc, which itself slows the stage down a little).
+#every operation's result is checked, a stage that did not do all its work stops the run with a non-zero exit
+#status so a broken build never reports fast timings
+
+CLASSES = ["tree", "shrub"]
+SPLIT = "70/20/10"
+
+
+# points config at a temp folder and a throwaway database, must run before db and the handlers are imported
+# param: root: temp folder images, models and the working directory are created in
+# param: mongomock: use the in-memory mongomock client instead of the MongoDB at MONGO_URI
+def configure(root, mongomock):
+    config.BASE_IMAGE_DIR = os.path.join(root, "images")
+    config.BASE_MODEL_DIR = os.path.join(root, "models")
+    config.WORKING_DIR = os.path.join(root, "working")
+    config.IMAGE_CACHE_DIR = os.path.join(root, "image_cache")
+    config.DB_NAME = f"DMSBenchmark_{os.getpid()}"
+    # variants are generated on a separate process pool and would only add noise
+    config.VARIANT_RESOLUTIONS = []
+    for folder in (config.BASE_IMAGE_DIR, config.BASE_MODEL_DIR, config.WORKING_DIR):
+        os.makedirs(folder, exist_ok=True)
+
+    if mongomock:
+        import mongomock as mongomock_module
+        import pymongo
+        pymongo.MongoClient = mongomock_module.MongoClient
+
+
+# file name of a synthetic image in the format capture devices send
+# param: n: index of the image
+# param: rng: random.Random
+# return: file name
+def image_name(n, rng):
+    lat = rng.uniform(-44.0, -40.0)
+    lon = rng.uniform(170.0, 176.0)
+    capture_date = date(2024, 1, 1) + timedelta(days=rng.randrange(365))
+    return f"ICS_{n}_lat_{lat:.6f}_lon_{lon:.6f}_img_{capture_date.isoformat()}.jpg"
+
+
+# generates synthetic images, every image has different contents so none are treated as duplicates
+# param: count: number of images
+# param: image_bytes: size of each image
+# param: seed: seed of the generator, the same seed gives the same images
+# return: generator of (file name, file object)
+def generate_images(count, image_bytes, seed):
+    rng = random.Random(seed)
+    for n in range(count):
+        yield image_name(n, rng), io.BytesIO(rng.randbytes(image_bytes))
+
+
+# generates a synthetic annotation document for a photo
+# param: photo_id: id of photo
+# param: rng: random.Random
+# return: annotation document in the layout POST /annotations takes
+def generate_annotation(photo_id, rng):
+    lines = []
+    for _ in range(rng.randint(1, 8)):
+        w, h = rng.uniform(0.02, 0.3), rng.uniform(0.02, 0.3)
+        x, y = rng.uniform(w / 2, 1 - w / 2), rng.uniform(h / 2, 1 - h / 2)
+        lines.append(f"{rng.randrange(len(CLASSES))} {x:.6f} {y:.6f} {w:.6f} {h:.6f}")
+    return {"photo_id": photo_id, "classes": list(CLASSES), "annotation": lines}
+
+
+# raised when a stage's operations did not succeed, its timings would be meaningless
+class BenchmarkError(Exception):
+    pass
+
+
+# times an operation once per item
+# param: size: data size the stage runs at
+# param: stage: name of the stage
+# param: operation: function called with each item
+# param: items: iterable of items, generating them is not timed
+# param: check: function called with each operation's result, returning an error message or None if it succeeded
+# return: result dict for the stage, raises BenchmarkError if any operation failed its check
+def measure(size, stage, operation, items, check=None):
+    latencies = []
+    errors = []
+    tracemalloc.start()
+    try:
+        for item in items:
+            start = time.perf_counter()
+            outcome = operation(item)
+            latencies.append(time.perf_counter() - start)
+            error = check(outcome) if check is not None else None
+            if error is not None:
+                errors.append(error)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    if errors:
+        raise BenchmarkError(f"{stage} at size {size}: {len(errors)} of {len(latencies)} operations failed, e.g. {errors[0]}")
+
+    seconds = sum(latencies)
+    result = {
+        "size": size,
+        "stage": stage,
+        "ops": len(latencies),
+        "seconds": round(seconds, 6),
+        "ops_per_second": round(len(latencies) / seconds, 3) if seconds else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": percentile(latencies, 100),
+        },
+        "peak_memory_bytes": peak,
+    }
+    print(f"{size:>8} {stage:<28} {result['ops']:>7} ops {result['ops_per_second'] or 0:>10.1f}/s "
+          f"p50 {result['latency_ms']['p50']:.2f}ms p99 {result['latency_ms']['p99']:.2f}ms "
+          f"peak {peak / 1024**2:.1f}MiB")
+    return result
+
+
+# nearest rank percentile of a list of durations
+# return: milliseconds, None for an empty list
+def percentile(latencies, p):
+    if not latencies:
+        return None
+    ordered = sorted(latencies)
+    index = max(0, min(len(ordered) - 1, int(round(p / 100 * len(ordered))) - 1))
+    return round(ordered[index] * 1000, 3)
+
+
+# runs every stage at one data size on an empty database
+# param: size: number of images
+# param: args: parsed command line arguments
+# return: list of stage results
+def run_size(size, args):
+    # imported here as they read config when imported, see configure
+    import db
+    import dataset_handler
+    import image_handler
+    import job_dirs
+
+    reset(db)
+    results = []
+    seed = args.seed + size
+    rng = random.Random(seed)
+
+    # single uploads through the same coroutine POST /trees awaits, the rest of the images through the bulk path
+    single = min(size, args.single_uploads)
+    loop = asyncio.new_event_loop()
+    photo_ids = []
+
+    def upload(image):
+        result = loop.run_until_complete(image_handler.save_uploaded_image(SimpleNamespace(filename=image[0], file=image[1])))
+        if result is not None:
+            photo_ids.append(result[0]["_id"])
+        return result
+    images = generate_images(size, args.image_bytes, seed)
+    results.append(measure(size, "save_uploaded_image", upload, (next(images) for _ in range(single)), check_upload))
+    loop.close()
+
+    def bulk_ingest(batch):
+        entries = image_handler.ingest_images(batch)
+        photo_ids.extend(entry["id"] for entry in entries if entry["status"] == "ok")
+        return entries
+    results.append(measure(size, "ingest_images (bulk)", bulk_ingest, [images],
+                           lambda entries: check_ingest(entries, size - single)))
+    ingest = results[-1]
+    if size > single:
+        ingest["images_per_second"] = round((size - single) / ingest["seconds"], 3)
+
+    annotations = [generate_annotation(photo_id, rng) for photo_id in photo_ids]
+    results.append(measure(size, "save_annotations", db.save_annotations, annotations,
+                           lambda saved: None if saved else "annotation not saved"))
+    sample = rng.sample(photo_ids, min(len(photo_ids), args.lookups))
+    results.append(measure(size, "get_annotations_for_photo", lambda photo_id: list(db.get_annotations_for_photo(photo_id)),
+                           sample, lambda found: None if len(found) == 1 else f"{len(found)} annotations found, expected 1"))
+
+    dataset_ids = []
+    names = [f"benchmark_{size}_{n}" for n in range(args.repeats)]
+
+    def create(name):
+        dataset_id = db.create_dataset({}, SPLIT, name, ",".join(CLASSES), seed)
+        if dataset_id:
+            dataset_ids.append(dataset_id)
+        return dataset_id
+    results.append(measure(size, "create_dataset", create, names,
+                           lambda dataset_id: check_dataset(db, dataset_id, size)))
+
+    loads = (("get_dataset_photos", dataset_handler.get_dataset_photos, False),
+             ("load_dataset", dataset_handler.load_dataset, True))
+    for n, (stage, load, with_labels) in enumerate(loads):
+        # each load gets its own dataset so neither starts with the other's cached files
+        dataset_id = dataset_ids[n % len(dataset_ids)]
+        # the first load links every file, the second only checks what changed
+        for state in ("cold", "warm"):
+            def run_load(_):
+                loaded = load(dataset_id)
+                # counted before the job directory is removed, counting is not part of the load but is timed with it
+                counts = count_files(loaded["path"])
+                job_dirs.remove_job_dir(loaded["job_id"])
+                return counts
+            results.append(measure(size, f"{stage} ({state})", run_load, [None],
+                                   lambda counts: check_load(counts, size, with_labels)))
+    return results
+
+
+# checks a single upload stored a new image
+# return: error message, None if it succeeded
+def check_upload(result):
+    if result is None:
+        return "upload failed"
+    if result[1]:
+        return f"{result[0]['_id']} stored as a duplicate"
+    return None
+
+
+# checks a bulk ingest stored every image
+# return: error message, None if it succeeded
+def check_ingest(entries, expected):
+    failed = [entry for entry in entries if entry["status"] != "ok"]
+    if failed:
+        return f"{len(failed)} images not stored, e.g. {failed[0]}"
+    if len(entries) != expected:
+        return f"{len(entries)} images stored, expected {expected}"
+    return None
+
+
+# checks a dataset was created holding every image
+# return: error message, None if it succeeded
+def check_dataset(db, dataset_id, expected):
+    if not dataset_id:
+        return "dataset not created"
+    photos = sum(db.get_dataset_from_id(dataset_id).get("photo_counts", {}).values())
+    if photos != expected:
+        return f"dataset holds {photos} images, expected {expected}"
+    return None
+
+
+# checks a load placed an image, and a label if loaded with labels, for every image
+# return: error message, None if it succeeded
+def check_load(counts, expected, with_labels):
+    images, labels = counts
+    if images != expected:
+        return f"{images} images placed, expected {expected}"
+    if with_labels and labels != expected:
+        return f"{labels} labels written, expected {expected}"
+    return None
+
+
+# number of images and label files in a loaded dataset folder
+# return: (images, labels)
+def count_files(dataset_folder):
+    counts = []
+    for kind in ("images", "labels"):
+        folder = os.path.join(dataset_folder, kind)
+        counts.append(sum(len(files) for _, _, files in os.walk(folder)) if os.path.isdir(folder) else 0)
+    return tuple(counts)
+
+
+# empties the benchmark database and image store between data sizes
+def reset(db):
+    db.client.drop_database(config.DB_NAME)
+    db.lookup_cache.invalidate("datasets")
+    db.lookup_cache.invalidate("models")
+    for folder in (config.BASE_IMAGE_DIR, config.WORKING_DIR, config.IMAGE_CACHE_DIR):
+        shutil.rmtree(folder, ignore_errors=True)
+        os.makedirs(folder)
+    db.ensure_indexes()
+
+
+# commit the benchmark ran on, so results can be compared across releases
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the DMS hot paths on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="numbers of images to run at")
+    parser.add_argument("--image-bytes", type=int, default=64 * 1024, help="size of each synthetic image")
+    parser.add_argument("--single-uploads", type=int, default=200, help="images uploaded one at a time, the rest in bulk")
+    parser.add_argument("--lookups", type=int, default=500, help="annotation lookups timed per size")
+    parser.add_argument("--repeats", type=int, default=3, help="datasets created per size")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data")
+    parser.add_argument("--mongomock", action="store_true", help="use an in-memory stand-in instead of MongoDB")
+    parser.add_argument("--output", help="JSON file the results are written to")
+    parser.add_argument("--keep", action="store_true", help="keep the temp folder and database afterwards")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="dms-benchmark-")
+    configure(root, args.mongomock)
+    import db
+
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+    results = []
+    failure = None
+    try:
+        for size in args.sizes:
+            results.extend(run_size(size, args))
+    except BenchmarkError as e:
+        failure = str(e)
+        print(f"Benchmark failed: {failure}")
+    finally:
+        if not args.keep:
+            db.client.drop_database(config.DB_NAME)
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {
+        "started_at": started_at,
+        "git_commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "mongo": "mongomock" if args.mongomock else config.MONGO_URI,
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "keep")},
+        # whole process high water mark, kilobytes on linux
+        "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "results": results,
+        # set when a stage failed, the results then stop before it
+        "failure": failure,
+    }
+    output = args.output or f"benchmark-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {output}")
+    if failure is not None:
+        sys.exit(1)
@@ -3,13 +3,77 @@
 BASE_IMAGE_DIR = "/media/dj66/KINGSTON/Images"
 BASE_MODEL_DIR = "/home/dj66/Documents/Honours/Models"
 
+# Bytes read and written at a time when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# Time without a new chunk after which a resumable model upload is abandoned and its partial file removed
+UPLOAD_SESSION_TTL_SECONDS = 24 * 60 * 60
+# Number of image metadata documents sent in each insert_many during bulk ingest
+IMAGE_INSERT_BATCH_SIZE = 1000
+# Number of annotation upserts sent in each bulk_write during bulk annotation ingest
+ANNOTATION_WRITE_BATCH_SIZE = 1000
+# Longest side in pixels of the resized copies made of every ingested image, datasets can be loaded at these sizes
+# needs Pillow installed, an empty list turns variant generation off
+VARIANT_RESOLUTIONS = [640, 1280]
+# Number of processes resizing images into variants
+VARIANT_WORKERS = 4
+
+# Folder on a fast local disk holding copies of archive images used by dataset loads, and newly ingested images
+# until they are moved to BASE_IMAGE_DIR once cold. None turns the cache tier off and images are used from BASE_IMAGE_DIR
+IMAGE_CACHE_DIR = "/home/dj66/Documents/Honours/ImageCache"
+# Disk space the cache tier may use, least recently used copies are evicted beyond it
+IMAGE_CACHE_QUOTA_BYTES = 100 * 1024**3
+# Whether new uploads are written to the cache tier instead of straight to BASE_IMAGE_DIR
+STORE_NEW_IMAGES_IN_CACHE = True
+# Time without use after which an ingested image is moved from the cache tier to BASE_IMAGE_DIR
+IMAGE_COLD_AFTER_SECONDS = 14 * 24 * 60 * 60
+# Number of images copied from BASE_IMAGE_DIR at once when prefetching, kept low for slow devices such as USB sticks
+PREFETCH_WORKERS = 4
+# Number of cold images moved to BASE_IMAGE_DIR at a time, dataset loads wait while a batch is moved
+DEMOTE_BATCH_SIZE = 100
+
 #Directory for temp files such as loaded datasets, the file system  its on must be able to support symlinks
 WORKING_DIR ="/home/dj66/Documents/Honours/WorkingDir"
 
+# How dataset images are placed in the working directory: "symlink", "hardlink", "reflink" or "copy"
+# hardlink and reflink require WORKING_DIR and BASE_IMAGE_DIR to be on the same file system
+MATERIALIZE_MODE = "symlink"
+# Number of threads shared by all dataset loads for linking/copying images
+MATERIALIZE_WORKERS = 16
+# Disk space loaded datasets may use in WORKING_DIR before the least recently used are evicted
+DATASET_CACHE_QUOTA_BYTES = 20 * 1024**3
+# Target size of each shard file when a dataset is exported as shards
+SHARD_SIZE_BYTES = 1024**3
+# Age after which a dataset load's job directory (and its data.yaml) is removed
+JOB_DIR_TTL_SECONDS = 7 * 24 * 60 * 60
+# Number of dataset loads that run at once in the background, further loads are queued
+DATASET_JOB_WORKERS = 2
+# How long the status of a finished background job can still be polled
+FINISHED_JOB_TTL_SECONDS = 24 * 60 * 60
+
 # MongoDB variables
 MONGO_URI = "mongodb://localhost:27017/"
+# Connections the client may open to MongoDB, also the number of threads the async API runs database calls on
+MONGO_MAX_POOL_SIZE = 50
+# Timeouts in milliseconds for finding a server, opening a connection, waiting for a reply and waiting for a free connection
+MONGO_SERVER_SELECTION_TIMEOUT_MS = 5000
+MONGO_CONNECT_TIMEOUT_MS = 5000
+MONGO_SOCKET_TIMEOUT_MS = 120000
+MONGO_WAIT_QUEUE_TIMEOUT_MS = 10000
 DB_NAME = "TreesDB"
 TREE_COLLECTION_NAME = "Trees_Test"
 DATASET_COLLECTION_NAME = "Datasets"
 MODEL_COLLECTION_NAME = "Models" 
 ANNOTATION_COLLECTION_NAME = "Annotations"
+MEMBERSHIP_COLLECTION_NAME = "DatasetMembership"
+
+# Number of dataset download plans (archive layout and label contents) kept in memory, and how long each is reused
+# a download resumed within the TTL skips rebuilding the plan, changes to the dataset show up in downloads after it
+DOWNLOAD_PLAN_CACHE_ENTRIES = 8
+DOWNLOAD_PLAN_TTL_SECONDS = 600
+
+# Number of ids sent in each $in query for bulk lookups such as annotations and file paths
+ID_QUERY_CHUNK_SIZE = 5000
+# Number of dataset/model name lookups cached in process, and how long each is trusted
+# the TTL bounds how stale a lookup can be after a write made by another process
+LOOKUP_CACHE_MAX_ENTRIES = 1024
+LOOKUP_CACHE_TTL_SECONDS = 30
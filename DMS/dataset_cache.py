@@ -0,0 +1,350 @@
+from config import WORKING_DIR, DATASET_CACHE_QUOTA_BYTES, MATERIALIZE_MODE, IMAGE_CACHE_DIR
+import db
+import image_tiers
+import job_dirs
+import materialize
+import metrics
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+
+#this file keeps a materialized copy of each loaded dataset in the working directory,
+#fingerprinted against the dataset document so repeat loads only update what changed.
+#each load is handed a snapshot of the cached copy in its job directory, so a later load updating the cache
+#never changes the files a training run is reading
+
+CACHE_DIR = os.path.abspath(os.path.join(WORKING_DIR, "dataset_cache"))
+MANIFEST_NAME = "manifest.json"
+# folder in a job directory the snapshot of the loaded dataset is placed in
+SNAPSHOT_NAME = "dataset"
+SPLITS = ["train", "test", "val"]
+
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+# returns the lock guarding the cached copy of a dataset
+# param: dataset_id: cache key of the dataset, its id with "@resolution" for variants
+# return: threading.Lock
+def get_dataset_lock(dataset_id):
+    with _locks_lock:
+        return _locks.setdefault(dataset_id, threading.Lock())
+
+
+# brings the cached copy of a dataset up to date with its document
+# param: dataset: dataset document
+# param: with_labels: whether the YOLO label files are synced as well as the images
+# param: progress_callback: optional function called with (stage, done, total) as files are placed and written
+# param: resolution: optional image variant resolution, each resolution is cached in its own folder
+# param: job_dir: optional job directory a snapshot of the synced dataset is placed in
+# return: path to the snapshot in job_dir if given, otherwise to the cached dataset folder
+def sync_dataset(dataset, with_labels, progress_callback=None, resolution=None, job_dir=None):
+    dataset_id = dataset["_id"]
+    cache_key = dataset_id if resolution is None else f"{dataset_id}@{resolution}"
+    cache_folder = os.path.join(CACHE_DIR, cache_key)
+
+    # images are not demoted while they are being linked
+    with get_dataset_lock(cache_key), image_tiers.loading() as pins:
+        manifest = read_manifest(cache_folder)
+        if manifest.get("mode") != MATERIALIZE_MODE or manifest.get("image_cache") != IMAGE_CACHE_DIR:
+            # images placed in another mode, or linked to another tier, cannot be reused
+            if os.path.exists(cache_folder):
+                shutil.rmtree(cache_folder)
+            manifest = new_manifest()
+        changed = False
+
+        if image_tiers.enabled():
+            # only job snapshots keep copies from eviction, copies linked by an idle cached dataset may be gone
+            placed_paths = [path for placed in manifest["images"].values() for path in placed.values()]
+            evictions = image_tiers.pin(placed_paths, pins)
+            if MATERIALIZE_MODE == "symlink" and manifest.get("tier_evictions") != evictions:
+                if remove_broken_links(cache_folder, manifest):
+                    manifest["images_fingerprint"] = None
+            manifest["tier_evictions"] = evictions
+
+        for split in SPLITS:
+            os.makedirs(os.path.join(cache_folder, "images", split), exist_ok=True)
+            os.makedirs(os.path.join(cache_folder, "labels", split), exist_ok=True)
+
+        with metrics.DATASET_STAGE_SECONDS.time(stage="query"):
+            photo_ids = {split: db.get_dataset_photo_ids(dataset, split) for split in SPLITS}
+            # an image's path changes when it is moved between tiers or its variant is made, so the paths are
+            # fingerprinted rather than only the ids
+            paths = {split: db.get_photo_paths(photo_ids[split], resolution) for split in SPLITS}
+        images_fingerprint = fingerprint(MATERIALIZE_MODE, {split: sorted(paths[split].items()) for split in SPLITS})
+        if manifest["images_fingerprint"] != images_fingerprint:
+            with metrics.DATASET_STAGE_SECONDS.time(stage="link"):
+                complete = sync_images(cache_folder, manifest, paths, progress_callback, pins)
+            # an incomplete sync is retried on the next load
+            manifest["images_fingerprint"] = images_fingerprint if complete else None
+            changed = True
+
+        if with_labels:
+            classes = dataset.get("classes", [])
+            with metrics.DATASET_STAGE_SECONDS.time(stage="query"):
+                versions = {split: db.get_annotation_versions(photo_ids[split], classes) for split in SPLITS}
+            labels_fingerprint = fingerprint(classes, {split: sorted(versions[split].items()) for split in SPLITS})
+            if manifest["labels_fingerprint"] != labels_fingerprint:
+                with metrics.DATASET_STAGE_SECONDS.time(stage="labels"):
+                    sync_labels(cache_folder, manifest, versions, classes, progress_callback)
+                manifest["labels_fingerprint"] = labels_fingerprint
+                changed = True
+
+        if changed:
+            manifest["size"] = folder_size(cache_folder)
+        manifest["last_used"] = time.time()
+        write_manifest(cache_folder, manifest)
+
+        dataset_folder = cache_folder
+        if job_dir is not None:
+            # taken under the lock so no other load changes the cache part way through
+            dataset_folder = os.path.join(job_dir, SNAPSHOT_NAME)
+            with metrics.DATASET_STAGE_SECONDS.time(stage="snapshot"):
+                snapshot(cache_folder, manifest, dataset_folder, with_labels, progress_callback)
+
+    evict(keep=cache_key)
+    # copies linked into job snapshots are never evicted from under them
+    image_tiers.evict(keep=referenced_image_paths())
+    return dataset_folder
+
+
+# links images added to the dataset, relinks those whose path changed and removes those no longer in it
+# param: cache_folder: cached dataset folder
+# param: manifest: manifest of the cached dataset, updated in place
+# param: photo_paths: dict mapping split to a dict of photo id to the path of the image it should contain
+# param: progress_callback: optional function called with (stage, done, total)
+# param: pins: optional list from image_tiers.loading the prefetched copies are pinned in
+# return: True if every image was placed
+def sync_images(cache_folder, manifest, photo_paths, progress_callback, pins=None):
+    complete = True
+    # copies running jobs link are not evicted to make room for this one
+    referenced = referenced_image_paths()
+    for split in SPLITS:
+        folder = os.path.join(cache_folder, "images", split)
+        placed = manifest["images"].setdefault(split, {})
+        wanted = photo_paths[split]
+
+        removed = [photo_id for photo_id in placed if wanted.get(photo_id) != placed[photo_id]]
+        for photo_id in removed:
+            remove_file(os.path.join(folder, os.path.basename(placed.pop(photo_id))))
+
+        paths = {photo_id: path for photo_id, path in wanted.items() if photo_id not in placed}
+        for path in paths.values():
+            # clears files left behind by an interrupted sync
+            remove_file(os.path.join(folder, os.path.basename(path)))
+
+        local_paths = {path: path for path in paths.values()}
+        if image_tiers.enabled():
+            # images are read from the fast cache tier rather than the archive during training
+            prefetch_progress = None
+            if progress_callback is not None:
+                prefetch_progress = lambda done, total, stage=f"prefetch/{split}": progress_callback(stage, done, total)
+            with metrics.DATASET_STAGE_SECONDS.time(stage="prefetch"):
+                local_paths = image_tiers.prefetch(list(paths.values()), prefetch_progress, referenced, pins)
+
+        split_progress = None
+        if progress_callback is not None:
+            split_progress = lambda done, total, stage=f"images/{split}": progress_callback(stage, done, total)
+        errors = materialize.materialize_files(list(local_paths.values()), folder, progress_callback=split_progress)
+        failed = set()
+        for path, error in errors:
+            print(f"Failed to place {path}: {error}")
+            failed.add(path)
+        for photo_id, path in paths.items():
+            # the manifest records the image's stored path, the file name is the same on either tier
+            if local_paths[path] not in failed:
+                placed[photo_id] = path
+
+        metrics.DATASET_FILES.inc(len(paths) - len(failed), kind="image", action="placed")
+        metrics.DATASET_FILES.inc(len(removed), kind="image", action="removed")
+        complete = complete and not errors
+        print(f"Subfolder {split} Done, {len(paths) - len(failed)} added, {len(removed)} removed")
+    return complete
+
+
+# removes the links of a cached dataset whose image is gone, e.g. an evicted copy, so they are placed again
+# param: cache_folder: cached dataset folder
+# param: manifest: manifest of the cached dataset, updated in place
+# return: number of links removed
+def remove_broken_links(cache_folder, manifest):
+    removed = 0
+    for split, placed in manifest["images"].items():
+        folder = os.path.join(cache_folder, "images", split)
+        for photo_id, path in list(placed.items()):
+            link_path = os.path.join(folder, os.path.basename(path))
+            if not os.path.exists(link_path):
+                remove_file(link_path)
+                del placed[photo_id]
+                removed += 1
+    if removed:
+        print(f"Relinking {removed} images of {os.path.basename(cache_folder)} evicted from the image cache")
+    return removed
+
+
+# rewrites the label files whose annotation changed and removes those no longer matched
+# param: cache_folder: cached dataset folder
+# param: manifest: manifest of the cached dataset, updated in place
+# param: versions: dict mapping split to a dict of photo id to annotation id
+# param: classes: list of classes of the dataset
+# param: progress_callback: optional function called with (stage, done, total)
+def sync_labels(cache_folder, manifest, versions, classes, progress_callback=None):
+    for split in SPLITS:
+        folder = os.path.join(cache_folder, "labels", split)
+        written = manifest["labels"].setdefault(split, {})
+        wanted = versions[split]
+
+        stale = [photo_id for photo_id in written if wanted.get(photo_id) != written[photo_id]]
+        for photo_id in stale:
+            remove_file(os.path.join(folder, f"{photo_id}.txt"))
+            del written[photo_id]
+
+        changed = [photo_id for photo_id in wanted if photo_id not in written]
+        annotations = db.get_annotations_for_photos(changed, classes)
+        total = len(annotations)
+        for i, (photo_id, annotation_text) in enumerate(annotations.items(), start=1):
+            # Create a .txt file for each image with YOLOv5 annotations, replaced rather than rewritten in place
+            # as snapshots may hardlink the old file
+            label_path = os.path.join(folder, f"{photo_id}.txt")
+            with open(label_path + ".tmp", "w") as f:
+                f.write(annotation_text)
+            os.replace(label_path + ".tmp", label_path)
+            written[photo_id] = wanted[photo_id]
+
+            if progress_callback is not None:
+                progress_callback(f"labels/{split}", i, total)
+
+        metrics.DATASET_FILES.inc(len(annotations), kind="label", action="placed")
+        metrics.DATASET_FILES.inc(len(stale), kind="label", action="removed")
+        print(f"Labels {split} Done, {len(annotations)} written, {len(stale)} removed")
+
+
+# places a copy of a cached dataset that later syncs do not change, symlinks are recreated and other files
+# hardlinked so it costs no more than the links themselves
+# param: cache_folder: cached dataset folder
+# param: manifest: manifest of the cached dataset, written into the snapshot so the images it links are kept
+# param: snapshot_folder: folder the snapshot is placed in, must not exist yet
+# param: with_labels: whether the label files are included as well as the images
+# param: progress_callback: optional function called with (stage, done, total)
+def snapshot(cache_folder, manifest, snapshot_folder, with_labels, progress_callback=None):
+    kinds = ["images", "labels"] if with_labels else ["images"]
+    for kind in kinds:
+        for split in SPLITS:
+            src_folder = os.path.join(cache_folder, kind, split)
+            dest_folder = os.path.join(snapshot_folder, kind, split)
+            os.makedirs(dest_folder)
+            src_paths = [entry.path for entry in os.scandir(src_folder) if not entry.name.endswith(".tmp")]
+
+            split_progress = None
+            if progress_callback is not None:
+                split_progress = lambda done, total, stage=f"snapshot/{kind}/{split}": progress_callback(stage, done, total)
+            errors = materialize.materialize_files(src_paths, dest_folder, materialize.SNAPSHOT_MODE, split_progress)
+            if errors:
+                path, error = errors[0]
+                raise OSError(f"Failed to snapshot {len(errors)} files of {cache_folder}, e.g. {path}: {error}")
+    write_manifest(snapshot_folder, {"images": manifest["images"]})
+
+
+# removes cached datasets, least recently used first, until the cache fits in its quota,
+# datasets with a live job directory are never evicted
+# param: keep: cache key (dataset id, with "@resolution" for variants) of a cached dataset that must not be evicted
+def evict(keep=None):
+    if not os.path.isdir(CACHE_DIR):
+        return
+    pinned = job_dirs.active_dataset_ids()
+
+    entries = []
+    for cache_key in os.listdir(CACHE_DIR):
+        manifest = read_manifest(os.path.join(CACHE_DIR, cache_key))
+        entries.append((manifest.get("last_used", 0), manifest.get("size", 0), cache_key))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, cache_key in sorted(entries):
+        if total <= DATASET_CACHE_QUOTA_BYTES:
+            break
+        # a job pins every resolution of its dataset
+        if cache_key == keep or cache_key.split("@")[0] in pinned:
+            continue
+        with get_dataset_lock(cache_key):
+            shutil.rmtree(os.path.join(CACHE_DIR, cache_key), ignore_errors=True)
+        total -= size
+        print(f"Evicted cached dataset {cache_key}")
+
+
+# local paths of the images linked into every job's snapshot, idle cached datasets do not hold on to theirs
+# so they cannot keep the image cache full, they are relinked by their next load instead
+# return: set of absolute paths on the cache tier
+def referenced_image_paths():
+    referenced = set()
+    if not image_tiers.enabled():
+        return referenced
+    folders = [os.path.join(job_dirs.JOBS_DIR, job_id, SNAPSHOT_NAME) for job_id, _ in job_dirs.list_jobs()]
+    for folder in folders:
+        manifest = read_manifest(folder)
+        for placed in manifest.get("images", {}).values():
+            for path in placed.values():
+                if image_tiers.on_cache_tier(path):
+                    referenced.add(os.path.abspath(path))
+                else:
+                    referenced.add(image_tiers.copy_path(path))
+    return referenced
+
+
+# hashes the given values into a fingerprint string
+# return: hex digest
+def fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+
+def new_manifest():
+    return {
+        "mode": MATERIALIZE_MODE,
+        "image_cache": IMAGE_CACHE_DIR,
+        "images_fingerprint": None,
+        "labels_fingerprint": None,
+        "images": {},
+        "labels": {},
+        "size": 0,
+        "last_used": 0,
+    }
+
+
+# reads the manifest of a cached dataset
+# param: cache_folder: cached dataset folder
+# return: manifest dict, empty if the dataset has not been cached
+def read_manifest(cache_folder):
+    try:
+        with open(os.path.join(cache_folder, MANIFEST_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# writes the manifest of a cached dataset, replacing the old one atomically
+def write_manifest(cache_folder, manifest):
+    manifest_path = os.path.join(cache_folder, MANIFEST_NAME)
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w") as f:
+        json.dump(manifest, f)
+    os.replace(temp_path, manifest_path)
+
+
+# total size in bytes of the files in a folder, symlinks are counted as links not targets
+def folder_size(folder):
+    total = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -1,70 +1,50 @@
-from config import WORKING_DIR
+from config import VARIANT_RESOLUTIONS
+import background_jobs
 import db
-import shutil
+import dataset_cache
+import image_tiers
+import job_dirs
+import metrics
+import shards
 import os
-from concurrent.futures import ThreadPoolExecutor
-import subprocess
 import yaml
 
 #this file handles moving datasets around the file system
 
 
-#copies the photos in a dataset into the working directory
-# param: dataset_id: id of dataset 
-def get_dataset_photos(dataset_id):
-
-    # Define the full paths
-    folder_name = f"loaded_dataset"
-     # added .zip extension
-    dataset_folder = os.path.join(WORKING_DIR, folder_name)
-    image_folder = os.path.join(dataset_folder, "images")       
-    annotations_folder = os.path.join(dataset_folder, "labels") 
-
-    # Ensure the temp folder is clean
-    if os.path.exists(dataset_folder):
-        shutil.rmtree(dataset_folder)
-    os.makedirs(dataset_folder)
-    os.makedirs(image_folder)
-    os.makedirs(annotations_folder)
+#links the photos in a dataset into its cached folder in the working directory, and snapshots them into a job directory
+# param: dataset_id: id of dataset
+# param: job_id: optional id for the job directory, e.g. the id of the background job running the load
+# param: progress_callback: optional function called with (stage, done, total)
+# param: resolution: optional image variant resolution to link instead of the originals
+# return: dict with the job id, job directory and path of the dataset snapshot in it
+def get_dataset_photos(dataset_id, job_id=None, progress_callback=None, resolution=None):
 
     dataset = db.get_dataset_from_id(dataset_id)
-    photo_types = ["train_photos", "test_photos", "val_photos"]
-
-    for photo_type in photo_types:
-        # Get photo IDs for all images of this type
-        photo_ids = dataset[photo_type]
-
-        photos = db.get_photos(photo_ids)
-        photo_paths = [photo["file_path"] for photo in photos]
-
-        # Create subfolder in images (e.g., images/train, images/test, images/val)
-        subfolder_name = photo_type.split("_")[0]  # 'train', 'test', 'val'
-        subfolder = os.path.join(image_folder, subfolder_name)
-        os.makedirs(subfolder, exist_ok=True)
-
-        # Copy images into relevant subfolder
-        total_photos = len(photo_paths)
-
-        for i, photo_path in enumerate(photo_paths, start=1):
-            if os.path.isfile(photo_path):
-                with ThreadPoolExecutor(max_workers=6) as executor:
-                    executor.submit(copy_file, photo_path, subfolder)
-            
-            if i % 50 == 0 or i == total_photos:
-                percent_done = (i / total_photos) * 100
-                print(f"{percent_done:.2f}% done")
-        print(f"Subfolder {photo_type.split('_')[0]} Done")
-    return dataset_folder
-
-#writes the data.yaml file into the working directory
-# param: classes: list of classes that have been annotated for 
-def write_yaml(classes):
+
+    # the job directory keeps the cached dataset from being evicted while in use
+    job_id, job_dir = job_dirs.create_job_dir(dataset_id, job_id)
+
+    try:
+        # only images that changed since the last load are linked or removed, the job gets its own snapshot
+        dataset_folder = dataset_cache.sync_dataset(dataset, False, progress_callback, resolution, job_dir)
+    except BaseException:
+        job_dirs.remove_job_dir(job_id)
+        raise
+    return {"job_id": job_id, "job_dir": job_dir, "path": dataset_folder}
+
+#writes the data.yaml file into a job directory
+# param: classes: list of classes that have been annotated for
+# param: dataset_folder: folder the dataset has been loaded into
+# param: job_dir: job directory the file is written to
+# return: path to the YAML file
+def write_yaml(classes, dataset_folder, job_dir):
     # Define the paths to train, val, and test directories
-    train_path = os.path.join(WORKING_DIR,"loaded_dataset/images", "train")
-    val_path = os.path.join(WORKING_DIR, "loaded_dataset/images", "val")
-    test_path = os.path.join(WORKING_DIR, "loaded_dataset/images", "test")
+    train_path = os.path.join(dataset_folder, "images", "train")
+    val_path = os.path.join(dataset_folder, "images", "val")
+    test_path = os.path.join(dataset_folder, "images", "test")
+
 
-    
     # Prepare the YAML content
     data_yaml = {
         "train": train_path,
@@ -73,102 +53,95 @@ def write_yaml(classes):
         "nc": len(classes),  # Number of classes
         "names": classes  # Class names
     }
-    
+
     # Define the output path for the YAML file
-    yaml_file_path = os.path.join(WORKING_DIR, "data.yaml")
+    yaml_file_path = os.path.join(job_dir, "data.yaml")
 
-    # If the YAML file exists, delete it
-    if os.path.exists(yaml_file_path):
-        os.remove(yaml_file_path)
-    
     # Write the YAML file
     with open(yaml_file_path, "w") as yaml_file:
         yaml.dump(data_yaml, yaml_file, default_flow_style=False)
-    
+    return yaml_file_path
+
 #loads an entire dataset into the working directory including annotations in YOLO ready format
 # param: dataset_id: id of dataset being loaded
-def load_dataset(dataset_id):
-    # Define the full paths
-    folder_name = f"loaded_dataset"
-    dataset_folder = os.path.join(WORKING_DIR, folder_name)
-    image_folder = os.path.join(dataset_folder, "images")       
-    annotations_folder = os.path.join(dataset_folder, "labels")
-    
-    # Ensure the temp folder is clean
-    if os.path.exists(dataset_folder):
-        shutil.rmtree(dataset_folder)
-    os.makedirs(dataset_folder)
-    os.makedirs(image_folder)
-    os.makedirs(annotations_folder)
+# param: job_id: optional id for the job directory, e.g. the id of the background job running the load
+# param: progress_callback: optional function called with (stage, done, total)
+# param: resolution: optional image variant resolution to link instead of the originals
+# return: dict with the job id, job directory, path of the dataset snapshot in it and data.yaml path
+def load_dataset(dataset_id, job_id=None, progress_callback=None, resolution=None):
 
     dataset = db.get_dataset_from_id(dataset_id)
-    photo_types = ["train_photos", "test_photos", "val_photos"]
+
+    # each load gets its own job directory so concurrent loads do not share a data.yaml
+    job_id, job_dir = job_dirs.create_job_dir(dataset_id, job_id)
 
     # Load the classes list for YOLOv5 format
     dataset_classes = dataset.get("classes", [])
 
-    for photo_type in photo_types:
-        # Get photo IDs for all images of this type
-        photo_ids = dataset[photo_type]
-     
-       
-        photos = db.get_photos(photo_ids)
-        photo_paths = [photo["file_path"] for photo in photos] 
-
-        # Create subfolder in images 
-        subfolder_name = photo_type.split("_")[0]  
-        subfolder = os.path.join(image_folder, subfolder_name)
-        os.makedirs(subfolder, exist_ok=True)
-
-        # Copy images into relevant subfolder
-        total_photos = len(photo_paths)
-
-        for i, photo_path in enumerate(photo_paths, start=1):
-            if os.path.isfile(photo_path):
-                with ThreadPoolExecutor(max_workers=6) as executor:
-                    executor.submit(copy_file, photo_path, subfolder)
-            
-            if i % 50 == 0 or i == total_photos:
-                percent_done = (i / total_photos) * 100
-                print(f"{percent_done:.2f}% done")
-        print(f"Subfolder {photo_type.split('_')[0]} Done")
-
-     
-       
-        # Now handle annotations
-        for photo_id in photo_ids:
-            annotations = db.get_annotations_for_photo(photo_id)
-           
-            
-            if annotations:
-                subfolder_annotations = os.path.join(annotations_folder, subfolder_name)
-                os.makedirs(subfolder_annotations, exist_ok=True)
-
-                for annotation in annotations:
-                    annotation_classes = annotation["classes"]
-                 
-                    if set(annotation_classes) == set(dataset_classes):
-                        annotation_data = annotation["annotation"]
-                    
-                        # Create a .txt file for each image with YOLOv5 annotations
-                        annotation_filename = os.path.join(subfolder_annotations,f"{photo_id}.txt")
-
-                        with open(annotation_filename, "w") as f:
-                            for line in annotation_data:
-                                f.write(line+"\n")
-        
-            if i % 50 == 0 or i == total_photos:
-                percent_done = (i / total_photos) * 100
-                print(f"{percent_done:.2f}% done for annotations")
-
-    write_yaml(dataset_classes)
-
-    print("Dataset loading complete")
-
-#creates symlink at the dest_path for pointing to src_path
-# method in its current form does not support windows
-def copy_file(src_path, dest_path):
-    result = subprocess.run(
-        ["ln", "-s", src_path, dest_path],
-        check=True
-    )
\ No newline at end of file
+    try:
+        # only images and label files that changed since the last load are rewritten, the job gets its own
+        # snapshot so loads that update the cache later leave this one's files as they are
+        dataset_folder = dataset_cache.sync_dataset(dataset, True, progress_callback, resolution, job_dir)
+
+        with metrics.DATASET_STAGE_SECONDS.time(stage="yaml"):
+            yaml_path = write_yaml(dataset_classes, dataset_folder, job_dir)
+    except BaseException:
+        job_dirs.remove_job_dir(job_id)
+        raise
+
+    print(f"Dataset {dataset_id} loading complete")
+    return {"job_id": job_id, "job_dir": job_dir, "path": dataset_folder, "yaml_path": yaml_path}
+
+#exports a dataset as shard files, a few large sequentially readable files per split holding images,
+#labels and an index, instead of a tree of links and label files
+# param: dataset_id: id of dataset being exported
+# param: job_id: optional id for the job directory, e.g. the id of the background job running the export
+# param: progress_callback: optional function called with (stage, done, total)
+# param: resolution: optional image variant resolution to shard instead of the originals
+# return: dict with the job id, job directory, shard folder path and shard manifest path
+def export_dataset_shards(dataset_id, job_id=None, progress_callback=None, resolution=None):
+
+    dataset = db.get_dataset_from_id(dataset_id)
+
+    job_id, job_dir = job_dirs.create_job_dir(dataset_id, job_id)
+    shard_folder = os.path.join(job_dir, "shards")
+
+    try:
+        manifest_path = shards.write_dataset_shards(dataset, shard_folder, progress_callback, resolution)
+    except BaseException:
+        job_dirs.remove_job_dir(job_id)
+        raise
+
+    print(f"Dataset {dataset_id} shard export complete")
+    return {"job_id": job_id, "job_dir": job_dir, "path": shard_folder, "manifest_path": manifest_path}
+
+#starts loading a dataset as a background job, the job's directory shares its id
+# param: dataset_id: id of dataset being loaded
+# param: with_labels: True for a full load_dataset, False to only link the photos
+# param: export_format: "tree" for the folder of links and label files, "shards" for shard files
+# param: resolution: optional image variant resolution, None for the original images
+# return: (job id, future of the load result)
+def start_load_job(dataset_id, with_labels, export_format="tree", resolution=None):
+    if resolution is not None and resolution not in VARIANT_RESOLUTIONS:
+        raise ValueError(f"No image variants at resolution {resolution}, available: {VARIANT_RESOLUTIONS}")
+    if export_format == "shards":
+        load = export_dataset_shards
+    elif export_format == "tree":
+        load = load_dataset if with_labels else get_dataset_photos
+    else:
+        raise ValueError(f"Unknown export format {export_format}")
+    return background_jobs.submit_job(
+        load.__name__,
+        lambda job_id, progress_callback: load(dataset_id, job_id, progress_callback, resolution)
+    )
+
+#starts a background job moving images that went cold on the cache tier to the archive,
+#images linked into job snapshots are left where they are
+# return: (job id, future of the result)
+def start_demote_job():
+    return background_jobs.submit_job(
+        "demote_cold_images",
+        lambda job_id, progress_callback: image_tiers.demote_cold_images(
+            progress_callback, dataset_cache.referenced_image_paths
+        )
+    )
@@ -0,0 +1,200 @@
+import hashlib
+import os
+import tarfile
+import threading
+import time
+import yaml
+from collections import OrderedDict
+from config import ID_QUERY_CHUNK_SIZE, UPLOAD_CHUNK_SIZE, DOWNLOAD_PLAN_CACHE_ENTRIES, DOWNLOAD_PLAN_TTL_SECONDS
+import db
+import image_tiers
+
+#this file streams a dataset as a tar archive of images, YOLO labels and data.yaml, built on the fly from the
+#dataset document. The archive layout is worked out up front so its size is known and any byte range can be
+#generated on its own, which lets remote IPS nodes resume interrupted downloads
+
+BLOCK_SIZE = 512
+
+# dataset id to (expiry time, plan) of recently built plans, most recently used last
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+# returns the plan of a dataset's archive, reusing one built in the last DOWNLOAD_PLAN_TTL_SECONDS.
+# building a plan queries every photo and label and stats every image, so without this each resumed range
+# request of a large dataset would repeat that work. A reused plan keeps its ETag and label bytes, so the bytes
+# served match what the client already has, and a changed dataset is downloaded once the plan expires
+# param: dataset_id: id of dataset
+# return: plan dict, see build_plan, None if there is no such dataset
+def get_plan(dataset_id):
+    now = time.monotonic()
+    with _plans_lock:
+        entry = _plans.get(dataset_id)
+        if entry is not None and entry[0] > now:
+            _plans.move_to_end(dataset_id)
+            return entry[1]
+
+    plan = build_plan(dataset_id)
+    if plan is not None:
+        with _plans_lock:
+            # plans are never modified once built, so one is shared by every request using it
+            _plans[dataset_id] = (now + DOWNLOAD_PLAN_TTL_SECONDS, plan)
+            _plans.move_to_end(dataset_id)
+            while len(_plans) > DOWNLOAD_PLAN_CACHE_ENTRIES:
+                _plans.popitem(last=False)
+    return plan
+
+
+# works out the members of a dataset's archive
+# param: dataset_id: id of dataset
+# return: plan dict with "members" (list of (name, size, source)), "size" in bytes and "etag",
+#         None if there is no such dataset
+def build_plan(dataset_id):
+    dataset = db.get_dataset_from_id(dataset_id)
+    if dataset is None:
+        return None
+    classes = dataset.get("classes", [])
+
+    members = []
+    for split in db.SPLITS:
+        photo_ids = sorted(db.get_dataset_photo_ids(dataset, split))
+        for start in range(0, len(photo_ids), ID_QUERY_CHUNK_SIZE):
+            chunk = photo_ids[start:start + ID_QUERY_CHUNK_SIZE]
+            paths = db.get_photo_paths(chunk)
+            labels = db.get_annotations_for_photos(chunk, classes)
+
+            for photo_id in chunk:
+                path = paths.get(photo_id)
+                try:
+                    size = os.stat(path).st_size
+                except (OSError, TypeError):
+                    print(f"Skipping {photo_id}, image file missing")
+                    continue
+                members.append((f"images/{split}/{os.path.basename(path)}", size, path))
+                if photo_id in labels:
+                    label = labels[photo_id].encode()
+                    members.append((f"labels/{split}/{photo_id}.txt", len(label), label))
+
+    data_yaml = yaml.dump({
+        "path": ".",
+        "train": "images/train",
+        "val": "images/val",
+        "test": "images/test",
+        "nc": len(classes),
+        "names": classes
+    }, default_flow_style=False).encode()
+    members.append(("data.yaml", len(data_yaml), data_yaml))
+
+    # identifies this exact layout, a resumed download must get the same bytes at the same offsets
+    etag = hashlib.sha1()
+    for name, size, source in members:
+        etag.update(f"{name}:{size}\n".encode())
+        if isinstance(source, bytes):
+            etag.update(source)
+
+    size = sum(BLOCK_SIZE + padded(member_size) for _, member_size, _ in members) + 2 * BLOCK_SIZE
+    return {"members": members, "size": size, "etag": f'"{etag.hexdigest()}"'}
+
+
+# generates the bytes of an archive between two offsets
+# param: plan: plan from build_plan
+# param: start: first byte offset, inclusive
+# param: end: last byte offset, inclusive
+# return: generator of byte chunks
+def iter_archive(plan, start, end):
+    offset = 0
+    for name, size, source in plan["members"]:
+        member_end = offset + BLOCK_SIZE + padded(size)
+        if member_end > start and offset <= end:
+            yield from iter_member(name, size, source, offset, start, end)
+        offset = member_end
+        if offset > end:
+            return
+
+    # two zero blocks mark the end of the archive
+    yield from clip(bytes(2 * BLOCK_SIZE), offset, start, end)
+
+
+# generates the part of one member (header, data and padding) that falls between start and end
+def iter_member(name, size, source, offset, start, end):
+    yield from clip(header(name, size), offset, start, end)
+    offset += BLOCK_SIZE
+
+    data_start = max(start - offset, 0)
+    data_end = min(end - offset + 1, size)
+    if data_start < data_end:
+        if isinstance(source, bytes):
+            yield source[data_start:data_end]
+        else:
+            yield from read_file_range(source, data_start, data_end)
+
+    padding = padded(size) - size
+    yield from clip(bytes(padding), offset + size, start, end)
+
+
+# reads part of a file in chunks, padding with zeros if the file has shrunk since the plan was made
+def read_file_range(path, data_start, data_end):
+    remaining = data_end - data_start
+    with open_image(path) as f:
+        f.seek(data_start)
+        while remaining > 0:
+            chunk = f.read(min(UPLOAD_CHUNK_SIZE, remaining))
+            if not chunk:
+                yield bytes(remaining)
+                return
+            remaining -= len(chunk)
+            yield chunk
+
+
+# opens an image of a plan, which may have been moved from the cache tier to the archive since the plan was made
+def open_image(path):
+    try:
+        return open(path, "rb")
+    except FileNotFoundError:
+        if image_tiers.enabled() and image_tiers.on_cache_tier(path):
+            # demotion keeps the image's path relative to the tier
+            return open(image_tiers.archive_path(path), "rb")
+        raise
+
+
+# tar header block for a member, fixed mode and mtime so the archive is the same every time
+def header(name, size):
+    info = tarfile.TarInfo(name)
+    info.size = size
+    info.mode = 0o644
+    info.mtime = 0
+    return info.tobuf(format=tarfile.USTAR_FORMAT)
+
+
+# yields the part of data (which starts at offset in the archive) that falls between start and end
+def clip(data, offset, start, end):
+    lower = max(start - offset, 0)
+    upper = min(end - offset + 1, len(data))
+    if lower < upper:
+        yield data[lower:upper]
+
+
+def padded(size):
+    return (size + BLOCK_SIZE - 1) // BLOCK_SIZE * BLOCK_SIZE
+
+
+# parses a single "bytes=start-end" range header against the archive size
+# param: range_header: value of the Range header, may be None
+# param: size: archive size in bytes
+# return: (start, end) inclusive, None for the whole archive, raises ValueError if the range cannot be satisfied
+def parse_range(range_header, size):
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        # multiple ranges are allowed to be answered with the whole archive
+        return None
+    first, _, last = range_header[len("bytes="):].strip().partition("-")
+    if first == "":
+        # suffix range, the last n bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = int(last) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError(f"Range {range_header} outside archive of {size} bytes")
+    return start, min(end, size - 1)
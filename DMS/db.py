@@ -1,17 +1,44 @@
-from pymongo import MongoClient
-from pymongo.errors import PyMongoError
-from config import MONGO_URI, DB_NAME, TREE_COLLECTION_NAME,DATASET_COLLECTION_NAME, MODEL_COLLECTION_NAME, ANNOTATION_COLLECTION_NAME
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import PyMongoError, BulkWriteError, OperationFailure, DuplicateKeyError
+from config import MONGO_URI, MONGO_MAX_POOL_SIZE, MONGO_SERVER_SELECTION_TIMEOUT_MS, MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS
+from config import DB_NAME, TREE_COLLECTION_NAME,DATASET_COLLECTION_NAME, MODEL_COLLECTION_NAME, ANNOTATION_COLLECTION_NAME, MEMBERSHIP_COLLECTION_NAME, ID_QUERY_CHUNK_SIZE, ANNOTATION_WRITE_BATCH_SIZE, LOOKUP_CACHE_MAX_ENTRIES, LOOKUP_CACHE_TTL_SECONDS
+import bisect
+import os
 import random
-from bson import ObjectId
+import re
+import hashlib
+import annotation_codec
+from lookup_cache import LookupCache
+import metrics
+from bson import ObjectId, Binary
 from datetime import datetime
 
+# mean earth radius, used to convert distances to radians for $centerSphere
+EARTH_RADIUS_METRES = 6378100
 
-client = MongoClient(MONGO_URI)
+# splits a dataset's photos are divided into
+SPLITS = ["train", "test", "val"]
+
+
+client = MongoClient(
+    MONGO_URI,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+    connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+    socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS,
+    waitQueueTimeoutMS=MONGO_WAIT_QUEUE_TIMEOUT_MS,
+    event_listeners=[metrics.MongoCommandListener()]
+)
 db = client[DB_NAME]
 tree_collection = db[TREE_COLLECTION_NAME]
 dataset_collection = db[DATASET_COLLECTION_NAME]
 model_collection = db[MODEL_COLLECTION_NAME]
 annotation_collection = db[ANNOTATION_COLLECTION_NAME]
+# one document per photo in a dataset: {"_id": "<dataset_id>:<photo_id>", "dataset_id", "split", "photo_id"}
+membership_collection = db[MEMBERSHIP_COLLECTION_NAME]
+
+# caches the dataset and model lookups the IPS polls, every write to those collections must invalidate its namespace
+lookup_cache = LookupCache(LOOKUP_CACHE_MAX_ENTRIES, LOOKUP_CACHE_TTL_SECONDS)
 
 #This file handles direct interactions with the database 
 
@@ -28,8 +55,19 @@ def generate_id():
 # param: collection: The collection to run query on 
 # param: field_filters: Dict of exact matches, e.g., {"location": "auckland"}
 # param: range_filters: Dict of range filters, e.g., {"capture_date": {"gte": "2024-12-01", "lte": "2024-12-05"}}
+# param: geo_filters: Dict of geospatial filters on the location point, see build_geo_query
+# param: projection: optional fields to return
 # return: Cursor to the matching documents        
-def dynamic_find(collection, exact_filters, range_filters):
+def dynamic_find(collection, exact_filters, range_filters, geo_filters=None, projection=None):
+    return collection.find(build_query(exact_filters, range_filters, geo_filters), projection)
+
+
+# Builds the query used by dynamic_find
+# param: exact_filters: Dict of exact matches
+# param: range_filters: Dict of range filters
+# param: geo_filters: Dict of geospatial filters
+# return: MongoDB query dict
+def build_query(exact_filters, range_filters, geo_filters=None):
 
     query = {}
     # Exact match fields
@@ -45,7 +83,58 @@ def dynamic_find(collection, exact_filters, range_filters):
             if "lte" in conditions:
                 range_query["$lte"] = conditions["lte"]
             query[field] = range_query
-    return collection.find(query)
+
+    # Geospatial filters, each is a $geoWithin on the location point so they can all use the 2dsphere index
+    if geo_filters:
+        conditions = build_geo_query(geo_filters)
+        if len(conditions) == 1:
+            query["location"] = conditions[0]
+        else:
+            query["$and"] = [{"location": condition} for condition in conditions]
+    return query
+
+
+# Builds the $geoWithin conditions for the geo part of a filter
+# param: geo_filters: Dict with any of
+#   "near": {"longitude": lon, "latitude": lat, "max_distance": metres}
+#   "bbox": [[min lon, min lat], [max lon, max lat]]
+#   "polygon": [[lon, lat], [lon, lat], ...] the ring is closed automatically
+# return: list of conditions on the location field
+def build_geo_query(geo_filters):
+    conditions = []
+    unknown = set(geo_filters) - {"near", "bbox", "polygon"}
+    if unknown:
+        raise ValueError(f"Unknown geo filters {sorted(unknown)}")
+
+    if "near" in geo_filters:
+        near = geo_filters["near"]
+        center = [float(near["longitude"]), float(near["latitude"])]
+        # $centerSphere takes its radius in radians
+        radius = float(near["max_distance"]) / EARTH_RADIUS_METRES
+        conditions.append({"$geoWithin": {"$centerSphere": [center, radius]}})
+
+    if "bbox" in geo_filters:
+        (min_lon, min_lat), (max_lon, max_lat) = geo_filters["bbox"]
+        ring = [[min_lon, min_lat], [max_lon, min_lat], [max_lon, max_lat], [min_lon, max_lat], [min_lon, min_lat]]
+        conditions.append({"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [ring]}}})
+
+    if "polygon" in geo_filters:
+        ring = [[float(lon), float(lat)] for lon, lat in geo_filters["polygon"]]
+        if len(ring) < 3:
+            raise ValueError("A polygon filter needs at least 3 points")
+        if ring[0] != ring[-1]:
+            ring.append(ring[0])
+        conditions.append({"$geoWithin": {"$geometry": {"type": "Polygon", "coordinates": [ring]}}})
+
+    return conditions
+
+
+# Builds the GeoJSON point stored on each tree document
+# param: latitude: latitude in degrees
+# param: longitude: longitude in degrees
+# return: GeoJSON Point dict
+def geo_point(latitude, longitude):
+    return {"type": "Point", "coordinates": [longitude, latitude]}
 
 
 # query's a collection using ID
@@ -56,6 +145,111 @@ def id_find(collection,id_list):
     return collection.find({"_id": {"$in": id_list}})
 
 
+######################## Index Management ########################
+
+# Indexes ensured at startup, per collection a list of (keys, options) as taken by create_index.
+# Unique indexes are partial so documents without the field (older or half created ones) do not collide
+INDEXES = {
+    TREE_COLLECTION_NAME: [
+        ([("sha256", 1)], {"name": "sha256_unique", "unique": True, "partialFilterExpression": {"sha256": {"$exists": True}}}),
+        ([("capture_date", 1)], {"name": "capture_date"}),
+        ([("location", "2dsphere")], {"name": "location_2dsphere"}),
+    ],
+    DATASET_COLLECTION_NAME: [
+        ([("name", 1)], {"name": "name_unique", "unique": True, "partialFilterExpression": {"name": {"$exists": True}}}),
+    ],
+    MODEL_COLLECTION_NAME: [
+        ([("name", 1)], {"name": "name_unique", "unique": True, "partialFilterExpression": {"name": {"$exists": True}}}),
+    ],
+    ANNOTATION_COLLECTION_NAME: [
+        ([("photo_id", 1)], {"name": "photo_id"}),
+        # one annotation per photo and class set, older annotations get their key from migrate.py annotation-keys
+        ([("photo_id", 1), ("class_key", 1)], {"name": "photo_class_key_unique", "unique": True, "partialFilterExpression": {"class_key": {"$exists": True}}}),
+    ],
+    MEMBERSHIP_COLLECTION_NAME: [
+        ([("dataset_id", 1), ("split", 1), ("photo_id", 1)], {"name": "dataset_split_photo"}),
+        ([("photo_id", 1)], {"name": "photo_id"}),
+    ],
+}
+
+# Collections that can be named in debug requests such as explain
+COLLECTIONS = {
+    "trees": tree_collection,
+    "datasets": dataset_collection,
+    "models": model_collection,
+    "annotations": annotation_collection,
+    "memberships": membership_collection,
+}
+
+# Creates the indexes in INDEXES, safe to call on every startup
+# an index that cannot be built (e.g. existing duplicates under a unique index) is reported and skipped
+# return: list of (collection name, index name, error message) for indexes that could not be created
+def ensure_indexes():
+    failures = []
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        for keys, options in indexes:
+            try:
+                collection.create_index(keys, **options)
+            except OperationFailure as e:
+                # duplicate images under sha256_unique can be merged with dedupe.py
+                print(f"Could not create index {options['name']} on {collection_name}: {e}")
+                failures.append((collection_name, options["name"], str(e)))
+    return failures
+
+# Lists the indexes of every collection
+# return: dict of collection name (key of COLLECTIONS) to list of index names
+def get_index_names():
+    return {name: list(collection.index_information().keys()) for name, collection in COLLECTIONS.items()}
+
+
+# Explains a dynamic_find query to show whether it uses an index
+# param: collection_name: key of COLLECTIONS
+# param: exact_filters: Dict of exact matches
+# param: range_filters: Dict of range filters
+# param: geo_filters: Dict of geospatial filters
+# return: summary of the winning plan and its execution stats
+def explain_find(collection_name, exact_filters, range_filters, geo_filters=None):
+    query = build_query(exact_filters, range_filters, geo_filters)
+    explanation = COLLECTIONS[collection_name].find(query).explain()
+
+    winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+    stats = explanation.get("executionStats", {})
+    stages, index_names = summarize_plan(winning_plan)
+    return {
+        "query": query,
+        "stages": stages,
+        "indexes_used": index_names,
+        "collection_scan": "COLLSCAN" in stages,
+        "documents_returned": stats.get("nReturned"),
+        "documents_examined": stats.get("totalDocsExamined"),
+        "keys_examined": stats.get("totalKeysExamined"),
+        "execution_time_ms": stats.get("executionTimeMillis"),
+    }
+
+
+# Flattens a query plan tree
+# param: plan: plan stage dict from explain
+# return: (list of stage names from the root down, list of index names used)
+def summarize_plan(plan):
+    stages = []
+    index_names = []
+    pending = [plan]
+    while pending:
+        stage = pending.pop()
+        # newer servers wrap the classic plan in queryPlan
+        if "queryPlan" in stage:
+            stage = stage["queryPlan"]
+        if "stage" in stage:
+            stages.append(stage["stage"])
+        if "indexName" in stage:
+            index_names.append(stage["indexName"])
+        if "inputStage" in stage:
+            pending.append(stage["inputStage"])
+        pending.extend(stage.get("inputStages", []))
+    return stages, index_names
+
+
 ######################## Image Related Methods ########################
 
 # Insert Image Metadata into tree collection
@@ -68,12 +262,190 @@ def insert_image_metadata(doc):
     except PyMongoError as e:
         return False
 
+# Insert many Image Metadata documents into tree collection with one unordered insert
+# param: docs: list of documents to be inserted
+# return: dict mapping the index of each document that failed to its error message
+def insert_many_image_metadata(docs):
+    if not docs:
+        return {}
+    try:
+        tree_collection.insert_many(docs, ordered=False)
+        return {}
+    except BulkWriteError as e:
+        return {error["index"]: error.get("errmsg", "insert failed") for error in e.details.get("writeErrors", [])}
+    except PyMongoError as e:
+        return {index: str(e) for index in range(len(docs))}
+
+# Adds the GeoJSON location point to images stored before it was recorded, in one server side update
+# return: number of images updated
+def backfill_locations():
+    result = tree_collection.update_many(
+        {"location": {"$exists": False}, "latitude": {"$type": "number"}, "longitude": {"$type": "number"}},
+        [{"$set": {"location": {"type": "Point", "coordinates": ["$longitude", "$latitude"]}}}]
+    )
+    return result.modified_count
+
+# Gets the image with a given content hash
+# param: sha256: hex digest of the image contents
+# return: matching document, None if there is none
+def get_photo_by_hash(sha256):
+    return tree_collection.find_one({"sha256": sha256})
+
+# Gets the images that were stored before content hashes were recorded
+# return: Cursor of _id and file_path of each such image
+def get_photos_missing_hash():
+    return tree_collection.find({"sha256": {"$exists": False}}, {"file_path": 1})
+
+# Records the content hash of an image
+# param: photo_id: id of photo
+# param: sha256: hex digest of the image contents
+# return: None, or the image already holding the hash under sha256_unique, in which case nothing is written
+def set_photo_hash(photo_id, sha256):
+    try:
+        tree_collection.update_one({"_id": photo_id}, {"$set": {"sha256": sha256}})
+    except DuplicateKeyError:
+        holder = get_photo_by_hash(sha256)
+        if holder is None:
+            # the holder was removed since, the hash is free
+            return set_photo_hash(photo_id, sha256)
+        return holder
+    return None
+
+# Finds groups of images sharing a content hash
+# return: Cursor of {"_id": sha256, "photos": [{"_id", "file_path"}, ...]} sorted oldest photo first
+def find_duplicate_photos():
+    return tree_collection.aggregate([
+        {"$match": {"sha256": {"$exists": True}}},
+        {"$sort": {"_id": 1}},
+        {"$group": {"_id": "$sha256", "photos": {"$push": {"_id": "$_id", "file_path": "$file_path"}}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ], allowDiskUse=True)
+
+# Merges duplicate images into one, pointing their datasets and annotations at the kept image
+# param: keep_id: id of the image that is kept
+# param: duplicate_ids: ids of the images merged into it, their documents are deleted
+def merge_duplicate_photos(keep_id, duplicate_ids):
+    photo_types = ["train_photos", "test_photos", "val_photos"]
+
+    for annotation in annotation_collection.find({"photo_id": {"$in": duplicate_ids}}, {"_id": 1}):
+        try:
+            annotation_collection.update_one({"_id": annotation["_id"]}, {"$set": {"photo_id": keep_id}})
+        except DuplicateKeyError:
+            # the kept image already has an annotation for the same class set
+            annotation_collection.delete_one({"_id": annotation["_id"]})
+
+    # the kept image takes the split of the first duplicate in each dataset that does not already have it
+    for membership in membership_collection.find({"photo_id": {"$in": duplicate_ids}}):
+        membership_collection.delete_one({"_id": membership["_id"]})
+        if add_dataset_photos(membership["dataset_id"], membership["split"], [keep_id]) == 0:
+            dataset_collection.update_one({"_id": membership["dataset_id"]}, {"$inc": {f"photo_counts.{membership['split']}": -1}})
+
+    # datasets not yet migrated to the membership collection
+    query = {"$or": [{photo_type: {"$in": duplicate_ids}} for photo_type in photo_types]}
+    for dataset in dataset_collection.find(query, {photo_type: 1 for photo_type in photo_types}):
+        # the kept image takes the place of the first duplicate found, unless the dataset already has it
+        has_kept = any(keep_id in dataset.get(photo_type, []) for photo_type in photo_types)
+        changes = {}
+        for photo_type in photo_types:
+            photo_ids = dataset.get(photo_type, [])
+            merged = []
+            for photo_id in photo_ids:
+                if photo_id in duplicate_ids:
+                    if has_kept:
+                        continue
+                    photo_id = keep_id
+                    has_kept = True
+                merged.append(photo_id)
+            if merged != photo_ids:
+                changes[photo_type] = merged
+        if changes:
+            dataset_collection.update_one({"_id": dataset["_id"]}, {"$set": changes})
+    lookup_cache.invalidate("datasets")
+
+    tree_collection.delete_many({"_id": {"$in": duplicate_ids}})
+
+# Builds a projection from a list of field names
+# param: fields: list of field names, None for every field
+# return: projection dict, None for every field
+def build_projection(fields):
+    if fields is None:
+        return None
+    # _id is always returned so it can be used as the cursor of the next page
+    return {field: 1 for field in fields}
+
+# Runs a find paginated on _id, pages are fetched by passing the last _id of the previous page as after
+# param: collection: collection to query
+# param: query: query dict
+# param: projection: projection dict, None for every field
+# param: after: _id the previous page ended on, None for the first page
+# param: limit: maximum number of documents, None for all
+# return: Cursor sorted by _id
+def paged_find(collection, query, projection=None, after=None, limit=None):
+    if after is not None:
+        query = {"$and": [query, {"_id": {"$gt": after}}]}
+    cursor = collection.find(query, projection).sort("_id", 1)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return cursor
+
 # Get a list of photos from db
 # param: id_list: list of photo id's
 # return: Cursor to the matching documents
 def get_photos(id_list):
     return id_find(tree_collection, id_list)
 
+# Get the file path of each photo from db
+# param: id_list: list of photo id's
+# param: resolution: optional variant resolution, the variant's path is returned where one has been made
+# return: dict mapping photo id to file path
+def get_photo_paths(id_list, resolution=None):
+    paths = {}
+    projection = {"file_path": 1}
+    if resolution is not None:
+        projection[f"variants.{resolution}"] = 1
+    for start in range(0, len(id_list), ID_QUERY_CHUNK_SIZE):
+        chunk = id_list[start:start + ID_QUERY_CHUNK_SIZE]
+        for photo in tree_collection.find({"_id": {"$in": chunk}}, projection):
+            # images without the variant yet fall back to the original
+            paths[photo["_id"]] = photo.get("variants", {}).get(str(resolution), photo["file_path"])
+    return paths
+
+# Finds images stored under a folder
+# param: folder: absolute path of the folder
+# return: Cursor of {"_id", "file_path", "variants"}
+def get_photos_under(folder):
+    prefix = folder.rstrip(os.sep) + os.sep
+    return tree_collection.find({"file_path": {"$regex": "^" + re.escape(prefix)}}, {"file_path": 1, "variants": 1})
+
+# Records a new location of an image and its variants after it has been moved
+# param: photo_id: id of photo
+# param: file_path: new path of the image
+# param: variants: dict of resolution (as a string) to variant path
+def set_photo_location(photo_id, file_path, variants):
+    changes = {"file_path": file_path}
+    if variants:
+        changes["variants"] = variants
+    tree_collection.update_one({"_id": photo_id}, {"$set": changes})
+
+# Finds images missing a variant at any of the given resolutions
+# param: resolutions: list of variant resolutions
+# return: Cursor of {"_id", "file_path"}
+def get_photos_missing_variants(resolutions):
+    return tree_collection.find(
+        {"$or": [{f"variants.{resolution}": {"$exists": False}} for resolution in resolutions]},
+        {"file_path": 1}
+    )
+
+# Records the resized variants of an image
+# param: photo_id: id of photo
+# param: variants: dict of resolution (as a string) to variant path
+def set_photo_variants(photo_id, variants):
+    if variants:
+        tree_collection.update_one(
+            {"_id": photo_id},
+            {"$set": {f"variants.{resolution}": path for resolution, path in variants.items()}}
+        )
+
 ######################## Dataset Related Methods ########################
 
 # generate a dataset given the filters provided 
@@ -84,11 +456,30 @@ def get_photos(id_list):
 #           },
 #   "range":{
 #             "field": {"gte": "max value", "lte": "min value"}
+#           },
+#   "geo":{
+#             "near": {"longitude": lon, "latitude": lat, "max_distance": metres},
+#             "bbox": [[min lon, min lat], [max lon, max lat]],
+#             "polygon": [[lon, lat], ...]
 #           }
 #}
 # param: split: String represeting the Train/Test/Val Split 
-# return: Id of dataset created, returns 0 if an error occurs
-def create_dataset(filters,split,name,classes):
+# param: seed: optional seed for the split, the same seed and photos always give the same split
+# return: Id of dataset created, returns 0 if an error occurs, raises ValueError for invalid filters or split
+def create_dataset(filters,split,name,classes, seed=None):
+
+    # the filters and split are checked before anything is written so a bad request leaves no half created dataset
+    try:
+        query = build_query(filters.get("exact", {}), filters.get("range", {}), filters.get("geo", {}))
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid filters: {e!r}")
+    try:
+        # split up into Train,Test, and Validation fractions
+        train, _, val = [int(part)*0.01 for part in split.split("/")]
+    except ValueError:
+        raise ValueError(f"Invalid split {split}, expected train/test/val percentages e.g. 70/20/10")
+
+    id = None
     try:
 
         #verify name
@@ -96,67 +487,93 @@ def create_dataset(filters,split,name,classes):
         if dataset_name_exists(name):
             return 0 
 
+        # seed recorded on the dataset so the split can be reproduced
+        if seed is None:
+            seed = random.getrandbits(32)
+
         # Insert an empty document 
         id = generate_id()
         created_at_str = datetime.now().strftime("%Y-%m-%d")
         dataset_collection.insert_one({"_id": id, "created_at": created_at_str})
        
-        #get photos with regards to filters
-        exact_filters = filters.get("exact", {})
-        range_filters = filters.get("range", {})
-       
-        photos = dynamic_find(tree_collection, exact_filters,range_filters)
-    
-        photos = list(photos)
+        #get photos with regards to filters, only their ids are fetched
+        photos = tree_collection.find(query, {"_id": 1})
     
         #turn classes into a list
         classes = classes.split(",")
-       
-
-        # split photos up into Train,Test, and Validation sets
-        random.shuffle(photos)
 
-        train = int(split.split("/")[0])*0.01
-        val = int(split.split("/")[2])*0.01
- 
+        # memberships are written in batches so the id lists are never held in full
+        pending = {split: [] for split in SPLITS}
+        photo_counts = {split: 0 for split in SPLITS}
+        for photo in photos:
+            position = split_position(photo["_id"], seed)
+            if position < train:
+                split_name = "train"
+            elif position < train + val:
+                split_name = "val"
+            else:
+                split_name = "test"
 
-        total = len(photos)
-        train_end = int(total * train)
-        val_end = train_end + int(total * val)
+            pending[split_name].append(photo["_id"])
+            if len(pending[split_name]) >= ID_QUERY_CHUNK_SIZE:
+                photo_counts[split_name] += add_dataset_photos(id, split_name, pending[split_name])
+                pending[split_name] = []
 
-        train_set = photos[:train_end]
-        val_set = photos[train_end:val_end]
-        test_set = photos[val_end:]
-
-       
-        # Update the dataset document with the photo IDs
-        train_photo_ids = [photo["_id"] for photo in train_set]
-        test_photo_ids = [photo["_id"] for photo in test_set]
-        val_photo_ids = [photo ["_id"] for photo in val_set]
+        for split_name in SPLITS:
+            photo_counts[split_name] += add_dataset_photos(id, split_name, pending[split_name])
        
+        # Update the dataset document, its photos are in the membership collection
         dataset_collection.update_one(
             {"_id": id},
             {
                 "$set": {
                     "classes": classes,
-                    "train_photos": train_photo_ids,
-                    "test_photos": test_photo_ids,
-                    "val_photos": val_photo_ids,
-                    "name": name
+                    "photo_counts": photo_counts,
+                    "name": name,
+                    "split": split,
+                    "split_seed": seed
                 }
             }
         )
+        lookup_cache.invalidate("datasets")
         
         return id 
         
     except PyMongoError as e:
+        # e.g. when a concurrent request took the name first
+        remove_partial_dataset(id)
         return 0
+    except BaseException:
+        remove_partial_dataset(id)
+        raise
+
+
+# removes the half created document and memberships of a dataset whose creation failed
+# param: dataset_id: id of the dataset, None if nothing was written yet
+def remove_partial_dataset(dataset_id):
+    if dataset_id is None:
+        return
+    dataset_collection.delete_one({"_id": dataset_id})
+    membership_collection.delete_many({"dataset_id": dataset_id})
+    lookup_cache.invalidate("datasets")
+
+
+# deterministic position of a photo in [0, 1) used to assign it to a split without shuffling
+# param: photo_id: id of photo
+# param: seed: split seed of the dataset
+# return: float in [0, 1)
+def split_position(photo_id, seed):
+    digest = hashlib.blake2b(f"{seed}:{photo_id}".encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
 
 
 # determines if a dataset name already exists in the database
 # param: name: name to be checked 
 # return: boolean of existing status 
 def dataset_name_exists(name):
+    return lookup_cache.get("datasets", "dataset_name_exists", name, lambda: load_dataset_name_exists(name))
+
+def load_dataset_name_exists(name):
     
     count = dataset_collection.count_documents({"name": name})
     if count > 0:
@@ -167,12 +584,17 @@ def dataset_name_exists(name):
 # param: name: name of dataset
 # return: Cursor to the matching document
 def get_dataset_from_name(name):
-    return dataset_collection.find_one({"name": name} )
+    return lookup_cache.get(
+        "datasets", "get_dataset_from_name", name, lambda: dataset_collection.find_one({"name": name})
+    )
 
 
 # Gets all dataset names
 # return: list of all dataset names in order A-Z
 def get_all_dataset_names():
+    return lookup_cache.get("datasets", "get_all_dataset_names", (), load_all_dataset_names)
+
+def load_all_dataset_names():
     
     all_datasets = dataset_collection.find({}, {"name": 1}).sort("name", 1)
     names = [doc["name"] for doc in all_datasets if "name" in doc]
@@ -184,17 +606,74 @@ def get_all_dataset_names():
 # param photo_id: id of photo
 def remove_photo_from_dataset(dataset_id, photo_id):
 
-    query = {"_id": dataset_id}
-
-    changes = [{"$pull": {"train_photos": photo_id}}, {"$pull": {"test_photos": photo_id}},{"$pull": {"val_photos": photo_id}} ]
+    membership = membership_collection.find_one_and_delete({"_id": membership_id(dataset_id, photo_id)})
+    if membership is not None:
+        dataset_collection.update_one({"_id": dataset_id}, {"$inc": {f"photo_counts.{membership['split']}": -1}})
+        lookup_cache.invalidate("datasets")
+        print(f"Removed photo_id {photo_id} from dataset {dataset_id}")
+        return
 
-    for change in changes:
-        result = dataset_collection.update_one(query,change)
-        if result.modified_count > 0:
-            print(f"Removed photo_id {photo_id} from dataset {dataset_id}")
-            return 
+    # datasets not yet migrated to the membership collection keep their photos in arrays
+    result = dataset_collection.update_one(
+        {"_id": dataset_id},
+        {"$pull": {"train_photos": photo_id, "test_photos": photo_id, "val_photos": photo_id}}
+    )
+    lookup_cache.invalidate("datasets")
+    if result.modified_count > 0:
+        print(f"Removed photo_id {photo_id} from dataset {dataset_id}")
+        return 
     
-    raise Exception("Failed to removed photo_id: {photo_id}, from dataset {dataset_id}: ")
+    raise Exception(f"Failed to removed photo_id: {photo_id}, from dataset {dataset_id}: ")
+
+# Removes many photos from a dataset at once, with one delete per split
+# param: dataset_id: id of dataset
+# param: photo_ids: list of photo ids
+# return: (list of ids removed, list of ids that were not in the dataset)
+def remove_photos_from_dataset(dataset_id, photo_ids):
+    photo_ids = list(dict.fromkeys(photo_ids))
+    removed = []
+
+    for start in range(0, len(photo_ids), ID_QUERY_CHUNK_SIZE):
+        chunk = photo_ids[start:start + ID_QUERY_CHUNK_SIZE]
+        keys = [membership_id(dataset_id, photo_id) for photo_id in chunk]
+
+        found = {split: [] for split in SPLITS}
+        for membership in membership_collection.find({"_id": {"$in": keys}}, {"split": 1, "photo_id": 1}):
+            found[membership["split"]].append(membership["photo_id"])
+
+        counts = {}
+        for split, split_ids in found.items():
+            if not split_ids:
+                continue
+            result = membership_collection.delete_many(
+                {"dataset_id": dataset_id, "split": split, "photo_id": {"$in": split_ids}}
+            )
+            counts[f"photo_counts.{split}"] = -result.deleted_count
+            removed.extend(split_ids)
+        if counts:
+            dataset_collection.update_one({"_id": dataset_id}, {"$inc": counts})
+
+    # datasets not yet migrated to the membership collection keep their photos in arrays
+    remaining = set(photo_ids) - set(removed)
+    if remaining:
+        dataset = dataset_collection.find_one({"_id": dataset_id}, {f"{split}_photos": 1 for split in SPLITS})
+        legacy_ids = set()
+        for split in SPLITS:
+            legacy_ids.update(remaining.intersection((dataset or {}).get(f"{split}_photos", [])))
+        if legacy_ids:
+            pulled = {"$in": list(legacy_ids)}
+            dataset_collection.update_one(
+                {"_id": dataset_id},
+                {"$pull": {f"{split}_photos": pulled for split in SPLITS}}
+            )
+            removed.extend(legacy_ids)
+    if removed:
+        lookup_cache.invalidate("datasets")
+
+    removed_set = set(removed)
+    not_found = [photo_id for photo_id in photo_ids if photo_id not in removed_set]
+    print(f"Removed {len(removed)} photos from dataset {dataset_id}, {len(not_found)} not found")
+    return removed, not_found
 
 # Gets a dataset based of dataset id
 # param: dataset_id: dataset id
@@ -202,31 +681,376 @@ def remove_photo_from_dataset(dataset_id, photo_id):
 def get_dataset_from_id(dataset_id):
     return dataset_collection.find_one({"_id": dataset_id})
 
+# Gets a dataset with its photo id lists filled in from the membership collection,
+# the layout datasets had before membership moved out of the document
+# param: dataset_id: dataset id
+# param: fields: optional list of fields to return, "<split>_photos" fills in that split's photo ids
+# return: dataset document with the photo id list of each split asked for, None if there is no such dataset
+def get_dataset_with_photos(dataset_id, fields=None):
+    projection = build_projection(fields)
+    if projection is not None:
+        # datasets not yet migrated keep their photos in arrays, get_dataset_photo_ids needs to see them
+        projection.update({f"{split}_photos": 1 for split in SPLITS})
+    dataset = dataset_collection.find_one({"_id": dataset_id}, projection)
+    if dataset is None:
+        return None
+    for split in SPLITS:
+        if fields is None or f"{split}_photos" in fields:
+            dataset[f"{split}_photos"] = get_dataset_photo_ids(dataset, split)
+        else:
+            dataset.pop(f"{split}_photos", None)
+    return dataset
+
+# Gets a dataset document without its photos
+# param: dataset_id: dataset id
+# param: fields: optional list of fields to return
+# return: dataset document, None if there is no such dataset
+def get_dataset_metadata(dataset_id, fields=None):
+    projection = build_projection(fields) or {f"{split}_photos": 0 for split in SPLITS}
+    return dataset_collection.find_one({"_id": dataset_id}, projection)
+
+# Streams the photo ids of a dataset split by split without building the id lists
+# param: dataset_id: dataset id
+# param: splits: list of splits to include
+# return: iterator of (split, photo id)
+def iter_dataset_photos(dataset_id, splits=SPLITS):
+    dataset = dataset_collection.find_one({"_id": dataset_id}, {f"{split}_photos": 1 for split in splits})
+    if dataset is None:
+        return
+    for split in splits:
+        if f"{split}_photos" in dataset:
+            for photo_id in dataset[f"{split}_photos"]:
+                yield split, photo_id
+            continue
+        cursor = membership_collection.find(
+            {"dataset_id": dataset_id, "split": split},
+            {"_id": 0, "photo_id": 1}
+        ).sort("photo_id", 1)
+        for membership in cursor:
+            yield split, membership["photo_id"]
+
+
+######################## Dataset Membership Methods ########################
+
+# builds the _id of a membership document, one photo can only be in one split of a dataset
+def membership_id(dataset_id, photo_id):
+    return f"{dataset_id}:{photo_id}"
+
+# Adds photos to a split of a dataset with one unordered insert, photos already in the dataset are skipped
+# param: dataset_id: id of dataset
+# param: split: "train", "test" or "val"
+# param: photo_ids: list of photo ids
+# return: number of photos added
+def add_dataset_photos(dataset_id, split, photo_ids):
+    if not photo_ids:
+        return 0
+    docs = [
+        {"_id": membership_id(dataset_id, photo_id), "dataset_id": dataset_id, "split": split, "photo_id": photo_id}
+        for photo_id in photo_ids
+    ]
+    try:
+        return len(membership_collection.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # duplicate key errors are photos already in the dataset, anything else is a real failure
+        errors = e.details.get("writeErrors", [])
+        if any(error.get("code") != 11000 for error in errors):
+            raise
+        return e.details.get("nInserted", 0)
+
+# Gets the ids of the photos in a split of a dataset, sorted by id
+# param: dataset: dataset document
+# param: split: "train", "test" or "val"
+# return: list of photo ids
+def get_dataset_photo_ids(dataset, split):
+    # datasets not yet migrated to the membership collection keep their photos in arrays
+    if f"{split}_photos" in dataset:
+        return dataset[f"{split}_photos"]
+    cursor = membership_collection.find(
+        {"dataset_id": dataset["_id"], "split": split},
+        {"_id": 0, "photo_id": 1}
+    ).sort("photo_id", 1)
+    return [membership["photo_id"] for membership in cursor]
+
+# Gets one page of the photo ids in a split of a dataset
+# param: dataset_id: id of dataset
+# param: split: "train", "test" or "val"
+# param: after: photo id the previous page ended on, None for the first page
+# param: limit: maximum number of ids returned
+# return: list of photo ids sorted by id
+def get_dataset_photo_page(dataset_id, split, after=None, limit=1000):
+    # datasets not yet migrated to the membership collection keep their photos in arrays
+    legacy = dataset_collection.find_one(
+        {"_id": dataset_id, f"{split}_photos": {"$exists": True}},
+        {f"{split}_photos": 1}
+    )
+    if legacy is not None:
+        photo_ids = sorted(legacy[f"{split}_photos"])
+        start = bisect.bisect_right(photo_ids, after) if after is not None else 0
+        return photo_ids[start:start + limit]
+
+    query = {"dataset_id": dataset_id, "split": split}
+    if after is not None:
+        query["photo_id"] = {"$gt": after}
+    cursor = membership_collection.find(query, {"_id": 0, "photo_id": 1}).sort("photo_id", 1).limit(limit)
+    return [membership["photo_id"] for membership in cursor]
+
+# Moves the photo arrays of a dataset document into the membership collection, safe to run again
+# param: dataset_id: id of dataset
+# return: dict of split to number of photos in it, None if the dataset had no arrays
+def migrate_dataset_membership(dataset_id):
+    dataset = get_dataset_from_id(dataset_id)
+    if not any(f"{split}_photos" in dataset for split in SPLITS):
+        return None
+
+    for split in SPLITS:
+        photo_ids = dataset.get(f"{split}_photos", [])
+        for start in range(0, len(photo_ids), ID_QUERY_CHUNK_SIZE):
+            add_dataset_photos(dataset_id, split, photo_ids[start:start + ID_QUERY_CHUNK_SIZE])
+
+    photo_counts = {
+        split: membership_collection.count_documents({"dataset_id": dataset_id, "split": split})
+        for split in SPLITS
+    }
+    dataset_collection.update_one(
+        {"_id": dataset_id},
+        {"$set": {"photo_counts": photo_counts}, "$unset": {f"{split}_photos": "" for split in SPLITS}}
+    )
+    lookup_cache.invalidate("datasets")
+    return photo_counts
+
+# Gets the ids of datasets whose photos are still stored as arrays in the dataset document
+# return: list of dataset ids
+def get_unmigrated_dataset_ids():
+    query = {"$or": [{f"{split}_photos": {"$exists": True}} for split in SPLITS]}
+    return [dataset["_id"] for dataset in dataset_collection.find(query, {"_id": 1})]
+
 
 ######################## Annotation Related Methods ########################
 
-# Saves annotation to database
+# Saves annotation to database, the YOLO lines are validated and stored as packed boxes,
+# replacing any earlier annotation of the photo for the same class set
 # param: document: document containing annotations, classes, and photo id
-# return: boolean indicating success
+# return: boolean indicating success, raises InvalidAnnotationError if a box is invalid
 def save_annotations(document):
     
+    encode_annotation(document)
     try:
-        annotation_id = generate_id()
-        created_at_str = datetime.now().strftime("%Y-%m-%d")
-        document["_id"] = annotation_id
-        document["created_at"] = created_at_str 
-        annotation_collection.insert_one(document)
+        annotation_collection.bulk_write([annotation_upsert(document)])
         return True
     except:
         return False
 
+# Saves many annotations with unordered upserts, one annotation is kept per photo and class set
+# param: documents: list of documents containing annotations, classes, and photo id
+# return: list with a result per document: {"index", "photo_id", "status"} where status is "created", "updated",
+#         "superseded" (a later document in the list has the same photo and class set) or "error" (with "error")
+def save_annotations_bulk(documents):
+    results = []
+    latest = {}
+    for index, document in enumerate(documents):
+        result = {"index": index, "photo_id": document.get("photo_id") if isinstance(document, dict) else None, "status": None}
+        results.append(result)
+        try:
+            if not isinstance(document, dict):
+                raise annotation_codec.InvalidAnnotationError("Annotation must be an object")
+            if not isinstance(document.get("photo_id"), str):
+                raise annotation_codec.InvalidAnnotationError("Missing photo_id")
+            encode_annotation(document)
+        except annotation_codec.InvalidAnnotationError as e:
+            result["status"] = "error"
+            result["error"] = str(e)
+            continue
+
+        # only the last annotation of a photo and class set in the request is written
+        key = (document["photo_id"], class_set_key(document.get("classes", [])))
+        if key in latest:
+            results[latest[key]]["status"] = "superseded"
+        latest[key] = index
+
+    indexes = list(latest.values())
+    for start in range(0, len(indexes), ANNOTATION_WRITE_BATCH_SIZE):
+        batch = indexes[start:start + ANNOTATION_WRITE_BATCH_SIZE]
+        operations = [annotation_upsert(documents[index]) for index in batch]
+        try:
+            upserted = annotation_collection.bulk_write(operations, ordered=False).upserted_ids
+            errors = {}
+        except BulkWriteError as e:
+            upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+            errors = {error["index"]: error.get("errmsg", "write failed") for error in e.details.get("writeErrors", [])}
+        except PyMongoError as e:
+            upserted = {}
+            errors = {position: str(e) for position in range(len(batch))}
+
+        for position, index in enumerate(batch):
+            if position in errors:
+                results[index]["status"] = "error"
+                results[index]["error"] = errors[position]
+            else:
+                results[index]["status"] = "created" if position in upserted else "updated"
+    return results
 
-# Retrieves annotations for a given photo 
+# Builds the upsert writing an encoded annotation over the photo's annotation for the same class set
+# param: document: annotation document after encode_annotation
+# return: UpdateOne
+def annotation_upsert(document):
+    fields = {field: value for field, value in document.items() if field not in ("_id", "created_at")}
+    fields["class_key"] = class_set_key(document.get("classes", []))
+    # changes on every write so cached label files know the annotation changed
+    fields["version"] = generate_id()
+    fields["updated_at"] = datetime.now().strftime("%Y-%m-%d")
+    return UpdateOne(
+        {"photo_id": document["photo_id"], "class_key": fields["class_key"]},
+        {"$set": fields, "$setOnInsert": {"_id": generate_id(), "created_at": fields["updated_at"]}},
+        upsert=True
+    )
+
+# Canonical key of a class set, annotations match a dataset when their class sets are equal whatever the order
+# param: classes: list of classes
+# return: string key
+def class_set_key(classes):
+    return ",".join(sorted(set(classes)))
+
+
+# Replaces the YOLO text lines of an annotation document with packed boxes
+# param: document: annotation document with "annotation" lines and "classes", changed in place
+def encode_annotation(document):
+    lines = document.pop("annotation", [])
+    classes = document.get("classes", [])
+    if not isinstance(classes, list) or not all(isinstance(name, str) for name in classes):
+        raise annotation_codec.InvalidAnnotationError("Classes must be a list of strings")
+    values = annotation_codec.parse_yolo_lines(lines, len(classes))
+    document["boxes"] = Binary(annotation_codec.pack_boxes(values))
+    document["box_count"] = len(values) // annotation_codec.BOX_FIELDS
+
+# Turns a stored annotation document back into the layout clients expect, with YOLO text lines
+# param: document: annotation document
+# return: the document with "annotation" lines instead of "boxes"
+def decode_annotation(document):
+    # left out when a projection did not ask for the annotation
+    if "boxes" in document or "annotation" in document:
+        document["annotation"] = annotation_codec.annotation_lines(document)
+        document.pop("boxes", None)
+    return document
+
+
+# Retrieves annotations for a given photo, oldest first
 # param: photo_id: photo id
-# return: Cursor to the matching documents
-def get_annotations_for_photo(photo_id):
+# param: fields: optional list of fields to return, "annotation" returns the YOLO text lines
+# param: after: annotation id the previous page ended on, None for the first page
+# param: limit: maximum number of annotations returned, None for all
+# return: iterator of the matching documents, with YOLO text lines
+def get_annotations_for_photo(photo_id, fields=None, after=None, limit=None):
+    projection = build_projection(fields)
+    if projection is not None and "annotation" in projection:
+        projection["boxes"] = 1
+    return map(decode_annotation, paged_find(annotation_collection, {"photo_id": photo_id}, projection, after, limit))
 
-  return annotation_collection.find({"photo_id" : photo_id })
+# Retrieves the annotations made for a given class set across many photos,
+# using a few chunked $in queries rather than one query per photo
+# param: photo_ids: list of photo ids, typically a whole dataset split
+# param: classes: list of classes the annotations must have been made for
+# return: dict mapping photo id to its YOLO label file text
+def get_annotations_for_photos(photo_ids, classes):
+    matches = find_matching_annotations(photo_ids, classes, {"annotation": 1, "boxes": 1})
+    return {photo_id: annotation_codec.annotation_text(annotation) for photo_id, annotation in matches.items()}
+
+
+# Retrieves the version of the annotation used for each photo for a given class set,
+# without transferring the annotation lines themselves
+# param: photo_ids: list of photo ids
+# param: classes: list of classes the annotations must have been made for
+# return: dict mapping photo id to an id that changes whenever the annotation is rewritten
+def get_annotation_versions(photo_ids, classes):
+    matches = find_matching_annotations(photo_ids, classes, {"version": 1})
+    return {photo_id: annotation.get("version", annotation["_id"]) for photo_id, annotation in matches.items()}
+
+
+# Finds the latest annotation per photo whose classes equal the given class set
+# param: photo_ids: list of photo ids
+# param: classes: list of classes the annotations must have been made for
+# param: projection: extra fields to return on top of _id, photo_id and classes
+# return: dict mapping photo id to the projected annotation document
+def find_matching_annotations(photo_ids, classes, projection):
+
+    key = class_set_key(classes)
+    projection = {"_id": 1, "photo_id": 1, "classes": 1, **projection}
+
+    annotations = {}
+    for start in range(0, len(photo_ids), ID_QUERY_CHUNK_SIZE):
+        chunk = photo_ids[start:start + ID_QUERY_CHUNK_SIZE]
+        # one annotation per photo and class set, found through the photo_class_key index
+        for annotation in annotation_collection.find({"photo_id": {"$in": chunk}, "class_key": key}, projection):
+            annotations[annotation["photo_id"]] = annotation
+
+        missing = [photo_id for photo_id in chunk if photo_id not in annotations]
+        if missing:
+            find_legacy_annotations(missing, classes, projection, annotations)
+    return annotations
+
+# Adds the latest matching annotation of annotations saved before class set keys existed, see migrate.py annotation-keys
+# param: photo_ids: list of photo ids with no keyed annotation
+# param: classes: list of classes the annotations must have been made for
+# param: projection: projection of find_matching_annotations
+# param: annotations: dict of photo id to annotation, updated in place
+def find_legacy_annotations(photo_ids, classes, projection, annotations):
+    class_set = set(classes)
+    query = {"photo_id": {"$in": photo_ids}, "class_key": {"$exists": False}}
+    if class_set:
+        # narrows the cursor server side, exact set equality is checked below
+        query["classes"] = {"$all": list(class_set)}
+    for annotation in annotation_collection.find(query, projection):
+        if set(annotation["classes"]) != class_set:
+            continue
+        # ids are ObjectId strings so the greatest id is the most recent annotation
+        current = annotations.get(annotation["photo_id"])
+        if current is None or annotation["_id"] > current["_id"]:
+            annotations[annotation["photo_id"]] = annotation
+
+# Gives annotations saved before class set keys existed their key, keeping only the latest annotation of each
+# photo and class set so the unique photo_class_key index holds, safe to run again
+# return: (number of annotations keyed, number of older duplicates deleted)
+def migrate_annotation_keys():
+    keyed = 0
+    deleted = 0
+    # newest first, so the first annotation to claim a photo and class set is the latest one
+    cursor = annotation_collection.find({"class_key": {"$exists": False}}, {"photo_id": 1, "classes": 1}).sort("_id", -1)
+    for annotation in cursor:
+        try:
+            annotation_collection.update_one(
+                {"_id": annotation["_id"]},
+                {"$set": {"class_key": class_set_key(annotation.get("classes", []))}}
+            )
+            keyed += 1
+        except DuplicateKeyError:
+            annotation_collection.delete_one({"_id": annotation["_id"]})
+            deleted += 1
+    return keyed, deleted
+
+
+# Converts annotations stored as YOLO text lines into packed boxes, in batched bulk writes
+# param: batch_size: number of updates sent per bulk_write
+# return: (number converted, list of (annotation id, error) for annotations that failed validation)
+def migrate_annotation_encoding(batch_size=1000):
+    converted = 0
+    invalid = []
+    updates = []
+    cursor = annotation_collection.find({"boxes": {"$exists": False}}, {"annotation": 1, "classes": 1})
+    for annotation in cursor:
+        try:
+            encode_annotation(annotation)
+        except annotation_codec.InvalidAnnotationError as e:
+            invalid.append((annotation["_id"], str(e)))
+            continue
+        updates.append(UpdateOne(
+            {"_id": annotation["_id"]},
+            {"$set": {"boxes": annotation["boxes"], "box_count": annotation["box_count"]}, "$unset": {"annotation": ""}}
+        ))
+        if len(updates) >= batch_size:
+            converted += annotation_collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        converted += annotation_collection.bulk_write(updates, ordered=False).modified_count
+    return converted, invalid
 
 
 ######################## Model Related Methods ########################
@@ -239,23 +1063,44 @@ def save_model(model_doc):
     model_doc["_id"] = model_id
     model_doc["base_model"] = False
     model_collection.insert_one(model_doc)
+    lookup_cache.invalidate("models")
     return model_id
 
-# saves path of model weights to the corresponding model document
+# saves path of model weights to the corresponding model document, in one update with their checksum and size
 # param: model_id: id of the model
 # param: file_path: path to model weights 
-def save_model_path(model_id,file_path):
-    model_collection.update_one({"_id": model_id},{"$set": {"path": file_path}})
+# param: sha256: hex digest of the weights
+# param: size: size of the weights in bytes
+def save_model_path(model_id,file_path, sha256=None, size=None):
+    result = model_collection.update_one(
+        {"_id": model_id},
+        {"$set": {"path": file_path, "sha256": sha256, "file_size": size}}
+    )
+    lookup_cache.invalidate("models")
+    if result.matched_count == 0:
+        raise Exception(f"No model with id {model_id}")
 
-# returns a list of all models
-# return: list of all models
-def get_all_models():
-    return list(model_collection.find({}))
+# determines if a model document exists
+# param: model_id: id of the model
+# return: boolean of existing status
+def model_exists(model_id):
+    return model_collection.count_documents({"_id": model_id}, limit=1) > 0
+
+# returns the models, in id order
+# param: fields: optional list of fields to return
+# param: after: model id the previous page ended on, None for the first page
+# param: limit: maximum number of models returned, None for all
+# return: Cursor to the models
+def get_all_models(fields=None, after=None, limit=None):
+    return paged_find(model_collection, {}, build_projection(fields), after, limit)
 
 # gets the path to a models weights
 # param: model_name: name of the model
 # return: path to model weights
 def get_model_path(model_name):
+    return lookup_cache.get("models", "get_model_path", model_name, lambda: load_model_path(model_name))
+
+def load_model_path(model_name):
     model = model_collection.find_one({"name":model_name})
     return model["path"]
 
@@ -263,6 +1108,9 @@ def get_model_path(model_name):
 # param: model_name: name to be checked 
 # return: boolean of existing status 
 def model_name_exists(model_name):
+    return lookup_cache.get("models", "model_name_exists", model_name, lambda: load_model_name_exists(model_name))
+
+def load_model_name_exists(model_name):
     count = model_collection.count_documents({"name": model_name})
     if count > 0:
         return True
@@ -0,0 +1,77 @@
+import argparse
+import os
+from config import UPLOAD_CHUNK_SIZE
+import db
+import utils
+
+#offline pass that merges images stored more than once, e.g. when a capture device re-sent an image after a network retry
+#usage: python dedupe.py [--dry-run]
+
+
+# hashes images stored before content hashes were recorded, an image whose hash is already held by another image
+# (the sha256_unique index allows only one) is merged with it straight away, keeping the older of the two
+# param: dry_run: if True nothing is written
+# return: (number of images hashed, number of duplicate images removed)
+def backfill_hashes(dry_run):
+    hashed = 0
+    removed = 0
+    for photo in db.get_photos_missing_hash():
+        try:
+            sha256 = utils.hash_file(photo["file_path"], UPLOAD_CHUNK_SIZE)
+        except OSError as e:
+            print(f"Could not hash {photo['_id']} at {photo['file_path']}: {e}")
+            continue
+        hashed += 1
+        if dry_run:
+            continue
+
+        holder = db.set_photo_hash(photo["_id"], sha256)
+        if holder is None:
+            continue
+        # ids are ObjectId strings so the smaller id is the older image
+        keep, duplicate = sorted([holder, photo], key=lambda p: p["_id"])
+        print(f"Merging {duplicate['_id']} into {keep['_id']}")
+        merge(keep, [duplicate])
+        removed += 1
+        if keep is photo:
+            # the hash is free now the newer image holding it is merged away
+            db.set_photo_hash(photo["_id"], sha256)
+    return hashed, removed
+
+
+# merges every group of images sharing a content hash into the oldest image of the group
+# param: dry_run: if True nothing is written or deleted
+# return: number of duplicate images removed
+def merge_duplicates(dry_run):
+    removed = 0
+    for group in db.find_duplicate_photos():
+        keep, duplicates = group["photos"][0], group["photos"][1:]
+        duplicate_ids = [photo["_id"] for photo in duplicates]
+        print(f"Merging {duplicate_ids} into {keep['_id']}")
+        removed += len(duplicates)
+        if not dry_run:
+            merge(keep, duplicates)
+    return removed
+
+
+# merges images into one and removes their files
+# param: keep: image kept, dict with "_id" and "file_path"
+# param: duplicates: list of images merged into it, dicts with "_id" and "file_path"
+def merge(keep, duplicates):
+    db.merge_duplicate_photos(keep["_id"], [photo["_id"] for photo in duplicates])
+    for photo in duplicates:
+        if photo["file_path"] != keep["file_path"] and os.path.exists(photo["file_path"]):
+            os.remove(photo["file_path"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Find and merge duplicate images in the tree collection")
+    parser.add_argument("--dry-run", action="store_true", help="report duplicates without changing anything")
+    args = parser.parse_args()
+
+    hashed, merged = backfill_hashes(args.dry_run)
+    print(f"Hashed {hashed} images, merged {merged} duplicates of already hashed images")
+    # without a backfill the hashes are not stored so a dry run can only report already hashed duplicates
+    print(f"Removed {merge_duplicates(args.dry_run)} duplicate images")
+    if not args.dry_run:
+        db.ensure_indexes()
@@ -1,48 +1,207 @@
 import os
+import tarfile
 from datetime import datetime
-from config import BASE_IMAGE_DIR
+from fastapi.concurrency import run_in_threadpool
+from config import BASE_IMAGE_DIR, UPLOAD_CHUNK_SIZE, IMAGE_INSERT_BATCH_SIZE, STORE_NEW_IMAGES_IN_CACHE
 import db
+import image_tiers
+import image_variants
+import metrics
+import utils
 
 # saves an uploaded image to file system and saves metadata
+# the image is streamed to disk in chunks off the event loop so memory per upload stays bounded,
+# an image already stored (same content hash) is not stored again
 # param: image file o be uploaded
-# return: metadata for image 
+# return: (metadata for image, True if it was a duplicate of an existing image), None on failure
 async def save_uploaded_image(file):
     
     try:
-        fileName = file.filename
-        #extract info from filename
-        parts = fileName.split("_")
-        lat = float(parts[3])      
-        lon = float(parts[5])      
-        date = parts[7].split(".")[0]
-        extension = parts[7].split(".")[1]
-
-        # convert date to required format
-        subfolderName = convert_to_yyyymmdd(date)
-
-        # create new directory for date 
-        target_dir = os.path.join(BASE_IMAGE_DIR, subfolderName)
-        os.makedirs(target_dir, exist_ok=True)
-
-        # generate unique ID
-        id = db.generate_id
-        file_path = os.path.join(target_dir,id+"."+extension)
-
-        
-        # save image to disk
-        with open(file_path, "wb") as f:
-            f.write(await file.read())
-
-        # return metadata
-        return {
-            "_id":id,
-            "latitude": lat,
-            "longitude":lon,
-            "capture_date" : date,
-            "file_path" : file_path
-        }
+        return await run_in_threadpool(ingest_image, file.filename, file.file)
     except:
         return None
+
+# saves an image and inserts its metadata, blocking
+# param: file_name: name of the image as sent by the capture device
+# param: src: file object of the image
+# return: (metadata for image, True if it was a duplicate of an existing image)
+def ingest_image(file_name, src):
+    try:
+        metadata, duplicate = store_image(file_name, src)
+    except Exception:
+        metrics.INGEST_FILES.inc(status="error")
+        raise
+    if duplicate:
+        metrics.INGEST_FILES.inc(status="duplicate")
+        return metadata, True
+
+    if db.insert_image_metadata(metadata):
+        metrics.INGEST_FILES.inc(status="ok")
+        metrics.INGEST_BYTES.inc(metadata["file_size"])
+        image_variants.schedule_variants(metadata["_id"], metadata["file_path"])
+        return metadata, False
+
+    # an identical image may have been inserted since the hash was checked
+    existing = resolve_failed_insert(metadata)
+    if existing is None:
+        metrics.INGEST_FILES.inc(status="error")
+        raise Exception(f"Failed to insert metadata for {file_name}")
+    metrics.INGEST_FILES.inc(status="duplicate")
+    return existing, True
+
+# saves many uploaded images and inserts their metadata in batches
+# param: files: list of uploaded image files
+# return: list of per file results with the filename, status, and id or error
+async def save_uploaded_images(files):
+    return await run_in_threadpool(ingest_images, ((file.filename, file.file) for file in files))
+
+# saves every image in an uploaded tar archive, the archive is read as a stream without extracting it
+# param: file: uploaded tar file, may be compressed
+# return: list of per file results with the filename, status, and id or error
+async def save_uploaded_tar(file):
+    return await run_in_threadpool(ingest_tar, file.file)
+
+# reads images out of a tar stream and ingests them, blocking
+# param: src: file object of the tar archive
+# return: list of per file results
+def ingest_tar(src):
+    results = []
+    try:
+        with tarfile.open(fileobj=src, mode="r|*") as tar:
+            # each member must be read before the stream moves on, ingest_images consumes them one at a time
+            members = ((os.path.basename(member.name), tar.extractfile(member)) for member in tar if member.isfile())
+            ingest_images(members, results)
+    except tarfile.TarError as e:
+        # images before the broken part of the archive are kept
+        results.append({"filename": None, "status": "error", "error": f"Invalid tar archive: {e}"})
+    return results
+
+# saves images to disk and inserts their metadata with batched unordered inserts, blocking
+# param: images: iterable of (file name, file object)
+# param: results: optional list the per file results are appended to
+# return: list of per file results
+def ingest_images(images, results=None):
+    if results is None:
+        results = []
+    first = len(results)
+    batch = []
+    try:
+        for file_name, src in images:
+            try:
+                metadata, duplicate = store_image(file_name, src)
+            except Exception as e:
+                results.append({"filename": file_name, "status": "error", "error": str(e)})
+                continue
+
+            if duplicate:
+                results.append({"filename": file_name, "id": metadata["_id"], "status": "duplicate"})
+                continue
+
+            result = {"filename": file_name, "id": metadata["_id"], "status": "ok"}
+            results.append(result)
+            batch.append((metadata, result))
+            if len(batch) >= IMAGE_INSERT_BATCH_SIZE:
+                insert_batch(batch)
+                batch = []
+    finally:
+        # images already stored keep their metadata even if reading the input fails
+        insert_batch(batch)
+        for result in results[first:]:
+            metrics.INGEST_FILES.inc(status=result["status"])
+    return results
+
+# inserts the metadata of a batch of stored images, marking failed inserts in their results
+# param: batch: list of (metadata, result)
+def insert_batch(batch):
+    errors = db.insert_many_image_metadata([metadata for metadata, _ in batch])
+    for index, error in errors.items():
+        metadata, result = batch[index]
+        existing = resolve_failed_insert(metadata)
+        if existing is not None:
+            # an identical image was inserted earlier in the batch or by another upload
+            result["status"] = "duplicate"
+            result["id"] = existing["_id"]
+        else:
+            result["status"] = "error"
+            result["error"] = error
+    for metadata, result in batch:
+        if result["status"] == "ok":
+            metrics.INGEST_BYTES.inc(metadata["file_size"])
+            # resized off the upload path on the variant process pool
+            image_variants.schedule_variants(metadata["_id"], metadata["file_path"])
+
+# cleans up after an image whose metadata insert failed
+# param: metadata: metadata of the stored image
+# return: the existing image with the same content hash, None if there is none
+def resolve_failed_insert(metadata):
+    # the file is useless without its metadata
+    if os.path.exists(metadata["file_path"]):
+        os.remove(metadata["file_path"])
+    return db.get_photo_by_hash(metadata["sha256"])
+
+# saves an image to disk and builds its metadata from its file name, blocking
+# the image is hashed while it is written and discarded if an image with the same hash is already stored
+# param: file_name: name of the image as sent by the capture device
+# param: src: file object of the image
+# return: (metadata for image, True if it was a duplicate in which case the metadata is the existing image's)
+def store_image(file_name, src):
+    lat, lon, date, extension = parse_image_filename(file_name)
+
+    # convert date to required format
+    subfolderName = convert_to_yyyymmdd(date)
+
+    # written to the fast cache tier when configured, demote_cold_images moves it to BASE_IMAGE_DIR later
+    if STORE_NEW_IMAGES_IN_CACHE and image_tiers.enabled():
+        target_dir = os.path.join(image_tiers.INGEST_DIR, subfolderName)
+    else:
+        target_dir = os.path.join(BASE_IMAGE_DIR, subfolderName)
+
+    # generate unique ID
+    id = db.generate_id()
+    file_path = os.path.join(target_dir,id+"."+extension)
+
+    # save image to disk
+    temp_path = file_path + ".part"
+    checksum, size = write_image(src, target_dir, temp_path)
+
+    existing = db.get_photo_by_hash(checksum)
+    if existing is not None:
+        os.remove(temp_path)
+        return existing, True
+    os.replace(temp_path, file_path)
+
+    # return metadata
+    return {
+        "_id":id,
+        "latitude": lat,
+        "longitude":lon,
+        "location" : db.geo_point(lat, lon),
+        "capture_date" : date,
+        "file_path" : file_path,
+        "sha256" : checksum,
+        "file_size" : size
+    }, False
+
+# extracts the metadata encoded in an image's file name
+# param: file_name: name of the form <..>_<..>_<..>_<lat>_<..>_<lon>_<..>_<YYYY-MM-DD>.<ext>
+# return: (latitude, longitude, capture date, extension)
+def parse_image_filename(file_name):
+    parts = file_name.split("_")
+    lat = float(parts[3])
+    lon = float(parts[5])
+    date = parts[7].split(".")[0]
+    extension = parts[7].split(".")[1]
+    return lat, lon, date, extension
+
+# writes an image to a temp file, blocking so run off the event loop
+# param: src: file object of the upload
+# param: target_dir: date directory the image is stored in
+# param: temp_path: path the image is written to
+# return: (sha256 hex digest, size in bytes)
+def write_image(src, target_dir, temp_path):
+    # create new directory for date
+    os.makedirs(target_dir, exist_ok=True)
+    return utils.stream_to_temp_file(src, temp_path, UPLOAD_CHUNK_SIZE)
     
 # converts original date stored in file name to new format
 # param: date_str: original date string
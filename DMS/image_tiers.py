@@ -0,0 +1,405 @@
+import os
+import shutil
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from config import (
+    BASE_IMAGE_DIR, IMAGE_CACHE_DIR, IMAGE_CACHE_QUOTA_BYTES, PREFETCH_WORKERS, IMAGE_COLD_AFTER_SECONDS,
+    DEMOTE_BATCH_SIZE
+)
+import db
+
+#this file keeps images on two tiers: the archive (BASE_IMAGE_DIR, large but slow) and a size bounded cache on a
+#local SSD (IMAGE_CACHE_DIR). The cache holds
+#   copies/  copies of archive images prefetched for dataset loads, evicted least recently used first
+#   images/  newly ingested images, moved to the archive once cold by demote_cold_images
+#a file's modification time is its last use, prefetching touches it.
+#dataset loads hold loading() while they place images, demotion waits for them and they wait for a batch being
+#demoted, so an image is never moved while a load is linking it. Copies prefetched by a running load are pinned
+#until it ends so eviction leaves them alone, after that only job snapshots keep them, idle cached datasets
+#are relinked if their copies are evicted
+
+COPY_DIR = os.path.abspath(os.path.join(IMAGE_CACHE_DIR, "copies")) if IMAGE_CACHE_DIR else None
+INGEST_DIR = os.path.abspath(os.path.join(IMAGE_CACHE_DIR, "images")) if IMAGE_CACHE_DIR else None
+# file holding the number of times copies have been evicted, cached datasets linked to copies check it to find
+# out their links may be broken
+EVICTIONS_PATH = os.path.join(IMAGE_CACHE_DIR, "evictions") if IMAGE_CACHE_DIR else None
+
+_executor = None
+_executor_lock = threading.Lock()
+_evict_lock = threading.Lock()
+# bytes of prefetches admitted under the quota but not yet on disk, guarded by _evict_lock
+_reserved = 0
+
+# state shared by loads and demotion, guarded by _usage
+_usage = threading.Condition()
+_loads = 0
+_demoting = False
+# local paths in use by running loads, with the number of loads using each
+_pinned = Counter()
+_demote_lock = threading.Lock()
+
+
+# True when a local cache tier is configured
+def enabled():
+    return IMAGE_CACHE_DIR is not None
+
+
+# returns the pool archive reads run on, its size bounds the reads made of the archive device at once
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="prefetch")
+        return _executor
+
+
+# path the cached copy of an archive image is kept at, the file name is kept so it can be linked in its place
+# param: file_path: path of the image in the archive
+# return: path in the copy cache
+def copy_path(file_path):
+    relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(BASE_IMAGE_DIR))
+    if relative.startswith(os.pardir):
+        # stored under an older BASE_IMAGE_DIR, kept apart by its parent folder
+        relative = os.path.join("other", os.path.basename(os.path.dirname(file_path)), os.path.basename(file_path))
+    return os.path.join(COPY_DIR, relative)
+
+
+# True if the path is on the cache tier already
+def on_cache_tier(file_path):
+    return os.path.abspath(file_path).startswith(os.path.abspath(IMAGE_CACHE_DIR) + os.sep)
+
+
+# held by a dataset load while it places images, waits for a batch being demoted to finish first
+# return: context manager giving the list the load's pins are recorded in, released when it exits
+@contextmanager
+def loading():
+    global _loads
+    pins = []
+    with _usage:
+        _usage.wait_for(lambda: not _demoting)
+        _loads += 1
+    try:
+        yield pins
+    finally:
+        with _usage:
+            _loads -= 1
+            for path in pins:
+                _pinned[path] -= 1
+                if _pinned[path] <= 0:
+                    del _pinned[path]
+            _usage.notify_all()
+
+
+# held while a batch of images is demoted, waits for running loads to finish and holds off new ones
+@contextmanager
+def demoting():
+    global _demoting
+    with _demote_lock:
+        with _usage:
+            _demoting = True
+            _usage.wait_for(lambda: _loads == 0)
+        try:
+            yield
+        finally:
+            with _usage:
+                _demoting = False
+                _usage.notify_all()
+
+
+# local paths in use by running loads
+def pinned_paths():
+    with _usage:
+        return set(_pinned)
+
+
+# copies images into the cache tier ahead of a dataset load, as many as fit in its quota after evicting
+# copies no dataset uses, the rest are read from the archive
+# param: file_paths: list of image paths
+# param: progress_callback: optional function called with (files_done, total_files)
+# param: keep: set of copy paths that must not be evicted to make room, e.g. those linked into job snapshots
+# param: pins: optional list from loading(), the local paths used are pinned until the load ends
+# return: dict mapping each path to the local path to use, the original path if it could not be cached
+def prefetch(file_paths, progress_callback=None, keep=frozenset(), pins=None):
+    local_paths = {}
+    pending = {}
+    total = len(file_paths)
+    done = 0
+    executor = get_executor()
+    max_in_flight = PREFETCH_WORKERS * 4
+    admitted = admit(file_paths, keep, pins)
+
+    def collect(finished):
+        nonlocal done
+        for future in finished:
+            file_path = pending.pop(future)
+            try:
+                local_paths[file_path] = future.result()
+            except OSError as e:
+                # the load falls back to the archive copy
+                print(f"Failed to prefetch {file_path}: {e}")
+                local_paths[file_path] = file_path
+            finally:
+                release(admitted[file_path])
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, total)
+
+    for file_path in file_paths:
+        if file_path not in admitted:
+            # over the quota, read from the archive
+            local_paths[file_path] = file_path
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, total)
+            continue
+        pending[executor.submit(fetch, file_path)] = file_path
+        if len(pending) >= max_in_flight:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+    finished, _ = wait(pending)
+    collect(finished)
+    return local_paths
+
+
+# decides which images fit on the cache tier, evicting the least recently used unneeded copies to make room,
+# and reserves their space until they are fetched
+# param: file_paths: list of image paths
+# param: keep: set of copy paths that must not be evicted
+# param: pins: optional list the admitted local paths are pinned in, see loading
+# return: dict mapping each admitted path to the bytes reserved for it
+def admit(file_paths, keep=frozenset(), pins=None):
+    global _reserved
+    local = {file_path: file_path if on_cache_tier(file_path) else copy_path(file_path) for file_path in file_paths}
+    with _evict_lock:
+        protected = set(keep) | pinned_paths() | set(local.values())
+        copies = list_files(COPY_DIR)
+        total = sum(size for _, size, _ in copies) + sum(size for _, size, _ in list_files(INGEST_DIR)) + _reserved
+        evictable = sorted(entry for entry in copies if entry[2] not in protected)
+        next_evict = 0
+        evicted = False
+
+        admitted = {}
+        for file_path, local_path in local.items():
+            if os.path.exists(local_path):
+                admitted[file_path] = 0
+                continue
+            try:
+                size = os.path.getsize(file_path)
+            except OSError:
+                # left to fetch to fail, the load then reports the missing image
+                admitted[file_path] = 0
+                continue
+            while total + size > IMAGE_CACHE_QUOTA_BYTES and next_evict < len(evictable):
+                _, evicted_size, evicted_path = evictable[next_evict]
+                next_evict += 1
+                try:
+                    os.remove(evicted_path)
+                except FileNotFoundError:
+                    pass
+                total -= evicted_size
+                evicted = True
+            if total + size <= IMAGE_CACHE_QUOTA_BYTES:
+                admitted[file_path] = size
+                total += size
+
+        if evicted:
+            record_evictions()
+        _reserved += sum(admitted.values())
+        if pins is not None:
+            with _usage:
+                for file_path in admitted:
+                    _pinned[local[file_path]] += 1
+                    pins.append(local[file_path])
+    if len(admitted) < len(file_paths):
+        print(f"Image cache full, {len(file_paths) - len(admitted)} images are read from the archive")
+    return admitted
+
+
+# pins the local paths of images a load has already linked, so eviction leaves them while it runs
+# param: file_paths: list of image paths
+# param: pins: list from loading() the local paths are recorded in
+# return: eviction count when pinned, later evictions cannot have removed any of the paths
+def pin(file_paths, pins):
+    with _evict_lock:
+        with _usage:
+            for file_path in file_paths:
+                local_path = os.path.abspath(file_path) if on_cache_tier(file_path) else copy_path(file_path)
+                _pinned[local_path] += 1
+                pins.append(local_path)
+        return eviction_count()
+
+
+# number of times copies have been evicted, 0 if never
+def eviction_count():
+    try:
+        with open(EVICTIONS_PATH) as f:
+            return int(f.read())
+    except (OSError, TypeError, ValueError):
+        return 0
+
+
+# counts an eviction, callers hold _evict_lock
+def record_evictions():
+    temp_path = EVICTIONS_PATH + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(str(eviction_count() + 1))
+    os.replace(temp_path, EVICTIONS_PATH)
+
+
+# frees the space reserved for a prefetched image once it is on disk or failed
+def release(size):
+    global _reserved
+    if size:
+        with _evict_lock:
+            _reserved -= size
+
+
+# makes sure one image is on the cache tier
+# param: file_path: path of the image
+# return: local path of the image
+def fetch(file_path):
+    local_path = file_path if on_cache_tier(file_path) else copy_path(file_path)
+    try:
+        # marks the image as recently used
+        os.utime(local_path)
+        return local_path
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(os.path.dirname(local_path), exist_ok=True)
+    temp_path = f"{local_path}.{threading.get_ident()}.part"
+    try:
+        shutil.copyfile(file_path, temp_path)
+        os.replace(temp_path, local_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return local_path
+
+
+# removes cached copies, least recently used first, until the cache tier fits in its quota
+# param: keep: set of copy paths that must not be removed, e.g. those linked into job snapshots
+def evict(keep=frozenset()):
+    if not enabled():
+        return
+    with _evict_lock:
+        copies = list_files(COPY_DIR)
+        total = sum(size for _, size, _ in copies) + sum(size for _, size, _ in list_files(INGEST_DIR))
+        pinned = pinned_paths()
+
+        evicted = False
+        for _, size, path in sorted(copies):
+            if total <= IMAGE_CACHE_QUOTA_BYTES:
+                break
+            if path in keep or path in pinned:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted = True
+        if evicted:
+            record_evictions()
+        if total > IMAGE_CACHE_QUOTA_BYTES:
+            print(f"Image cache is {total} bytes, over its quota as the rest is in use, run demote_cold_images")
+
+
+# moves ingested images that have not been used for IMAGE_COLD_AFTER_SECONDS, or the least recently used while the
+# cache tier is over its quota, to the archive and points their file_path there, meant to run as a background job.
+# images are moved DEMOTE_BATCH_SIZE at a time while no dataset load is running, and checked against the images in
+# use again before each batch
+# param: progress_callback: function called with (stage, done, total)
+# param: referenced: function returning the set of paths that must stay where they are, e.g. those linked into
+#        job snapshots
+# return: dict with the number of images moved, failed and kept as they came into use
+def demote_cold_images(progress_callback, referenced=frozenset):
+    if not enabled():
+        return {"moved": 0, "failed": 0, "kept": 0}
+    photos = {os.path.abspath(photo["file_path"]): photo for photo in db.get_photos_under(INGEST_DIR)}
+
+    images = [(mtime, size, path) for mtime, size, path in list_files(INGEST_DIR) if path in photos]
+    total = sum(size for _, size, _ in list_files(COPY_DIR)) + sum(size for _, size, _ in list_files(INGEST_DIR))
+    cold_before = time.time() - IMAGE_COLD_AFTER_SECONDS
+
+    keep = referenced()
+    candidates = []
+    for mtime, size, path in sorted(images):
+        if path in keep:
+            continue
+        if mtime < cold_before or total > IMAGE_CACHE_QUOTA_BYTES:
+            candidates.append(path)
+            total -= size
+
+    moved = 0
+    failed = 0
+    kept = 0
+    for start in range(0, len(candidates), DEMOTE_BATCH_SIZE):
+        batch = candidates[start:start + DEMOTE_BATCH_SIZE]
+        with demoting():
+            # loads that ran since the candidates were chosen may have linked some of them
+            keep = referenced()
+            for i, path in enumerate(batch, start=start + 1):
+                if path in keep:
+                    kept += 1
+                else:
+                    try:
+                        demote(photos[path])
+                        moved += 1
+                    except OSError as e:
+                        print(f"Failed to move {path} to the archive: {e}")
+                        failed += 1
+                progress_callback("demote", i, len(candidates))
+    return {"moved": moved, "failed": failed, "kept": kept}
+
+
+# moves one image and its variants from the cache tier to the archive, the database is updated before the
+# cache tier files are removed so the image is never missing
+# param: photo: image document with "_id", "file_path" and optionally "variants"
+def demote(photo):
+    moves = {photo["file_path"]: archive_path(photo["file_path"])}
+    variants = photo.get("variants", {})
+    for path in variants.values():
+        if on_cache_tier(path):
+            moves[path] = archive_path(path)
+
+    for src, dest in moves.items():
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copyfile(src, dest + ".part")
+        os.replace(dest + ".part", dest)
+
+    db.set_photo_location(
+        photo["_id"],
+        moves[photo["file_path"]],
+        {resolution: moves.get(path, path) for resolution, path in variants.items()}
+    )
+    for src in moves:
+        os.remove(src)
+
+
+# path in the archive of an image ingested into the cache tier
+def archive_path(file_path):
+    return os.path.join(BASE_IMAGE_DIR, os.path.relpath(file_path, INGEST_DIR))
+
+
+# lists the files under a folder, skipping partial copies
+# return: list of (modification time, size, absolute path)
+def list_files(folder):
+    files = []
+    if folder is None:
+        return files
+    for root, _, names in os.walk(folder):
+        for name in names:
+            if name.endswith(".part"):
+                continue
+            path = os.path.abspath(os.path.join(root, name))
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+    return files
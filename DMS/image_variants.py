@@ -0,0 +1,116 @@
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from config import VARIANT_RESOLUTIONS, VARIANT_WORKERS
+import db
+
+#this file generates resized copies of images at the fixed resolutions training runs at,
+#so the IPS does not decode and downsize full resolution originals every epoch.
+#a variant of <date dir>/<id>.<ext> at 640 is stored at <date dir>/640/<id>.<ext>, keeping the file name
+#so variants can be linked into datasets in place of the originals
+
+try:
+    from PIL import Image
+except ImportError:
+    # Pillow is only needed where variants are generated
+    Image = None
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# returns the process pool variants are generated on, created on first use
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ProcessPoolExecutor(max_workers=VARIANT_WORKERS)
+        return _executor
+
+
+# path of the variant of an image at a resolution
+# param: file_path: path of the original image
+# param: resolution: longest side of the variant in pixels
+# return: path of the variant
+def variant_path(file_path, resolution):
+    return os.path.join(os.path.dirname(file_path), str(resolution), os.path.basename(file_path))
+
+
+# writes the variants of one image, runs in a worker process
+# param: file_path: path of the original image
+# param: resolutions: list of resolutions to generate
+# return: dict of resolution (as a string) to variant path
+def make_variants(file_path, resolutions):
+    variants = {}
+    with Image.open(file_path) as image:
+        image.load()
+        for resolution in resolutions:
+            path = variant_path(file_path, resolution)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+            # longest side scaled to the resolution, smaller images are never upscaled
+            resized = image.copy()
+            resized.thumbnail((resolution, resolution), Image.LANCZOS)
+
+            temp_path = path + ".part"
+            resized.save(temp_path, format=image.format, quality=95)
+            os.replace(temp_path, path)
+            variants[str(resolution)] = path
+    return variants
+
+
+# generates the configured variants of a newly stored image in the background and records them on its document
+# param: photo_id: id of the image
+# param: file_path: path of the original image
+def schedule_variants(photo_id, file_path):
+    if Image is None or not VARIANT_RESOLUTIONS:
+        return
+    future = get_executor().submit(make_variants, file_path, VARIANT_RESOLUTIONS)
+    future.add_done_callback(lambda finished: record_variants(photo_id, file_path, finished))
+
+
+# saves the result of a finished variant generation
+def record_variants(photo_id, file_path, future):
+    try:
+        db.set_photo_variants(photo_id, future.result())
+    except Exception as e:
+        print(f"Failed to create variants of {file_path}: {e}")
+
+
+# generates missing variants for images stored before they were configured, meant to run as a background job
+# param: job_id: id of the background job, unused
+# param: progress_callback: function called with (stage, done, total)
+# return: dict with the number of images processed and failed
+def backfill_variants(job_id, progress_callback):
+    if Image is None:
+        raise RuntimeError("Pillow is required to generate image variants")
+
+    photos = list(db.get_photos_missing_variants(VARIANT_RESOLUTIONS))
+    total = len(photos)
+    done = 0
+    failed = 0
+    pending = {}
+    executor = get_executor()
+    max_in_flight = VARIANT_WORKERS * 4
+
+    def collect(finished):
+        nonlocal done, failed
+        for future in finished:
+            photo = pending.pop(future)
+            try:
+                db.set_photo_variants(photo["_id"], future.result())
+            except Exception as e:
+                print(f"Failed to create variants of {photo['file_path']}: {e}")
+                failed += 1
+            done += 1
+            progress_callback("variants", done, total)
+
+    for photo in photos:
+        pending[executor.submit(make_variants, photo["file_path"], VARIANT_RESOLUTIONS)] = photo
+        if len(pending) >= max_in_flight:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+    finished, _ = wait(pending)
+    collect(finished)
+
+    return {"processed": done, "failed": failed}
@@ -0,0 +1,86 @@
+from config import WORKING_DIR, JOB_DIR_TTL_SECONDS
+import db
+import json
+import os
+import shutil
+import time
+
+#this file handles the per job directories that dataset loads are given in the working directory,
+#so several loads can be prepared at once without sharing a data.yaml
+
+JOBS_DIR = os.path.join(WORKING_DIR, "jobs")
+JOB_INFO_NAME = "job.json"
+
+
+# creates a new job directory for a dataset load, removing expired ones first
+# param: dataset_id: id of the dataset being loaded
+# param: job_id: optional id to use for the job, a new one is generated otherwise
+# return: (job id, absolute path to the job directory)
+def create_job_dir(dataset_id, job_id=None):
+    cleanup_job_dirs()
+
+    if job_id is None:
+        job_id = db.generate_id()
+    job_dir = os.path.abspath(os.path.join(JOBS_DIR, job_id))
+    os.makedirs(job_dir)
+
+    with open(os.path.join(job_dir, JOB_INFO_NAME), "w") as f:
+        json.dump({"dataset_id": dataset_id, "created_at": time.time()}, f)
+    return job_id, job_dir
+
+
+# removes a job directory once its dataset is no longer needed
+# param: job_id: id of the job
+# return: True if the job directory existed
+def remove_job_dir(job_id):
+    job_dir = resolve_job_dir(job_id)
+    if job_dir is None or not os.path.isdir(job_dir):
+        return False
+    shutil.rmtree(job_dir, ignore_errors=True)
+    return True
+
+
+# path of a job directory, only ever a direct child of JOBS_DIR so a job id like ".." cannot reach other folders
+# param: job_id: id of the job, as sent by a client
+# return: absolute path to the job directory, None if the id cannot name one
+def resolve_job_dir(job_id):
+    jobs_dir = os.path.realpath(JOBS_DIR)
+    job_dir = os.path.realpath(os.path.join(jobs_dir, job_id))
+    if os.path.dirname(job_dir) != jobs_dir or os.path.basename(job_dir) != job_id:
+        return None
+    return job_dir
+
+
+# removes job directories older than JOB_DIR_TTL_SECONDS
+def cleanup_job_dirs():
+    now = time.time()
+    for job_id, info in list_jobs():
+        if now - info.get("created_at", 0) > JOB_DIR_TTL_SECONDS:
+            shutil.rmtree(os.path.join(JOBS_DIR, job_id), ignore_errors=True)
+
+
+# ids of datasets with a live job directory, these must not be evicted from the cache
+# return: set of dataset ids
+def active_dataset_ids():
+    return {info["dataset_id"] for _, info in list_jobs() if "dataset_id" in info}
+
+
+# lists the job directories and their job info
+# return: list of (job id, info dict)
+def list_jobs():
+    if not os.path.isdir(JOBS_DIR):
+        return []
+
+    jobs = []
+    for job_id in os.listdir(JOBS_DIR):
+        try:
+            with open(os.path.join(JOBS_DIR, job_id, JOB_INFO_NAME)) as f:
+                jobs.append((job_id, json.load(f)))
+        except (OSError, ValueError):
+            # a directory still being created or left half written, judged by its age instead
+            try:
+                created_at = os.path.getmtime(os.path.join(JOBS_DIR, job_id))
+            except OSError:
+                continue
+            jobs.append((job_id, {"created_at": created_at}))
+    return jobs
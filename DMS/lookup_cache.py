@@ -0,0 +1,63 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+#this file holds a small in-process read-through cache for database lookups that are read far more often than written.
+#entries are grouped by namespace (e.g. "datasets"), a write clears its whole namespace.
+#entries also expire after a TTL so writes made by other processes (migrations, other workers) are picked up
+
+
+class LookupCache:
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.hits = {}
+        self.misses = {}
+        self.lock = threading.Lock()
+
+    # returns the cached value of a lookup, loading and caching it on a miss
+    # param: namespace: group of entries the lookup belongs to, cleared together by invalidate
+    # param: name: name of the lookup, used for the hit/miss counters
+    # param: args: arguments of the lookup
+    # param: loader: function returning the value on a miss
+    # return: a copy of the value, so callers may modify it without changing the cache
+    def get(self, namespace, name, args, loader):
+        key = (namespace, name, args)
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits[name] = self.hits.get(name, 0) + 1
+                return copy.deepcopy(entry[1])
+            self.misses[name] = self.misses.get(name, 0) + 1
+            generation = self.generations.get(namespace, 0)
+
+        value = loader()
+
+        with self.lock:
+            # a write that happened while loading may have made the value stale, it is returned but not cached
+            if self.generations.get(namespace, 0) == generation:
+                self.entries[key] = (now + self.ttl_seconds, copy.deepcopy(value))
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return value
+
+    # drops every entry of a namespace
+    # param: namespace: namespace written to
+    def invalidate(self, namespace):
+        with self.lock:
+            self.generations[namespace] = self.generations.get(namespace, 0) + 1
+            for key in [key for key in self.entries if key[0] == namespace]:
+                del self.entries[key]
+
+    # hit and miss counts of each lookup
+    # return: dict with "hits" and "misses" (lookup name to count) and the number of cached "entries"
+    def stats(self):
+        with self.lock:
+            return {"hits": dict(self.hits), "misses": dict(self.misses), "entries": len(self.entries)}
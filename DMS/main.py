@@ -1,16 +1,85 @@
+import asyncio
+import json
 import os
-from fastapi import FastAPI, File, UploadFile , Response, HTTPException, Form
+from typing import List, Optional
+from fastapi import FastAPI, File, UploadFile , Response, HTTPException, Form, Request, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse, PlainTextResponse
 import image_handler 
+import annotation_codec
+import async_db
+import background_jobs
 import dataset_handler
+import dataset_stream
+import image_variants
+import job_dirs
+import metrics
 import model_handler
+import time
 import traceback
 import db
 import uvicorn
+from config import VARIANT_RESOLUTIONS
 
 
 
 app = FastAPI()
 
+# formats a dataset can be loaded in
+EXPORT_FORMATS = ("tree", "shards")
+# most items returned in one page of a paginated list
+MAX_PAGE_SIZE = 10000
+
+# splits a comma separated fields parameter into a list for projections
+def parse_fields(fields):
+    if fields is None:
+        return None
+    return [field.strip() for field in fields.split(",") if field.strip()]
+
+# streams documents as newline delimited JSON, one document per line
+# items should be a lazy db cursor or generator, it is iterated on the threadpool so memory stays constant
+def ndjson_response(items):
+    return StreamingResponse(
+        (json.dumps(item, default=str) + "\n" for item in items),
+        media_type="application/x-ndjson"
+    )
+
+# wraps a page of documents with the cursor of the next page, None once the last page is reached
+def page_response(key, documents, limit):
+    next_after = documents[-1]["_id"] if limit is not None and len(documents) == limit else None
+    return {key: documents, "next_after": next_after}
+
+# rejects a dataset load with an unknown format or a resolution no image variants are made at
+def check_load_options(format="tree", resolution=None):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown format {format}")
+    if resolution is not None and resolution not in VARIANT_RESOLUTIONS:
+        raise HTTPException(status_code=400, detail=f"No image variants at resolution {resolution}")
+
+# times every request by its route template, so /dataset?dataset_id=a and =b are one series
+@app.middleware("http")
+async def record_request_time(request: Request, call_next):
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        metrics.REQUEST_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=status
+        )
+
+# makes sure the collections are indexed before requests are served
+@app.on_event("startup")
+async def startup():
+    await async_db.ensure_indexes()
+    await run_in_threadpool(model_handler.cleanup_sessions)
+
 ######################## Image Requests ########################
 
 # handles the uploading of a image from a ICS instance 
@@ -18,14 +87,42 @@ app = FastAPI()
 async def upload_image(file: UploadFile = File(...)):
 
    
-    # extracts metadata from image name and then saves into image storage
-    metadata = await image_handler.save_uploaded_image(file)
-    if metadata == None:
+    # extracts metadata from image name, saves into image storage and stores metadata into database
+    result = await image_handler.save_uploaded_image(file)
+    if result == None:
         return Response(status_code=500)
-    
-    #stores metadata into database
-    db.insert_image_metadata(metadata)
-    return Response(status_code=200)
+
+    metadata, duplicate = result
+    return {"id": metadata["_id"], "duplicate": duplicate}
+
+
+# handles the uploading of many images in one multipart request, returns a result per file
+@app.post("/trees/bulk")
+async def upload_images(files: List[UploadFile] = File(...)):
+    results = await image_handler.save_uploaded_images(files)
+    return {"results": results}
+
+# handles the uploading of a tar archive of images, returns a result per file
+@app.post("/trees/tar")
+async def upload_image_tar(file: UploadFile = File(...)):
+    results = await image_handler.save_uploaded_tar(file)
+    return {"results": results}
+
+# starts a background job moving images on the local cache tier that have gone cold to the archive (BASE_IMAGE_DIR),
+# returns the job id to poll on /dataset/jobs
+@app.post("/trees/demote")
+async def demote_cold_images():
+    job_id, _ = dataset_handler.start_demote_job()
+    return {"job_id": job_id}
+
+# starts a background job making the configured resized variants of images stored before they were configured,
+# returns the job id to poll on /dataset/jobs
+@app.post("/trees/variants")
+async def backfill_image_variants():
+    if image_variants.Image is None:
+        raise HTTPException(status_code=501, detail="Pillow is not installed")
+    job_id, _ = background_jobs.submit_job("backfill_variants", image_variants.backfill_variants)
+    return {"job_id": job_id}
 
 
 ################ Dataset Requests ###################
@@ -33,12 +130,16 @@ async def upload_image(file: UploadFile = File(...)):
 
 #handles the creation of a dataset, returns id of created dataset
 @app.post("/dataset/photos")
-async def create_dataset(filters: dict, split: str, name: str, classes: str):
+async def create_dataset(filters: dict, split: str, name: str, classes: str, seed: Optional[int] = None):
     try:
-        dataset_id = db.create_dataset(filters,split,name,classes)
+        dataset_id = await async_db.create_dataset(filters,split,name,classes, seed)
         if dataset_id == 0:
             raise HTTPException(status_code=500, detail="Failed to create dataset")
         return {"id":dataset_id}
+    except HTTPException:
+        raise
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         print("Exception occurred:", e)
         traceback.print_exc()
@@ -47,13 +148,15 @@ async def create_dataset(filters: dict, split: str, name: str, classes: str):
 
 # groups the images into a folder so they can be accessed by IPS,
 # assumes IPS and Database Handler are on the same computer 
+# resolution links the resized variants of the images instead of the originals
 @app.get("/dataset/photos")
-async def dataset_photos(dataset_id: str):
+async def dataset_photos(dataset_id: str, resolution: Optional[int] = None):
+    check_load_options(resolution=resolution)
     try:
        
-        path = dataset_handler.get_dataset_photos(dataset_id)
-
-        return {"path" : path}
+        # runs on the dataset job pool so the event loop is not blocked
+        _, future = dataset_handler.start_load_job(dataset_id, with_labels=False, resolution=resolution)
+        return await asyncio.wrap_future(future)
     except Exception as e:
         print("Exception occurred:", e)
         traceback.print_exc()
@@ -64,7 +167,7 @@ async def dataset_photos(dataset_id: str):
 async def remove_photo_from_dataset(dataset_id: str, photo_id: str):
     try:
        
-        db.remove_photo_from_dataset(dataset_id,photo_id)
+        await async_db.remove_photo_from_dataset(dataset_id,photo_id)
 
         return Response(status_code=200)
     except Exception as e:
@@ -72,16 +175,27 @@ async def remove_photo_from_dataset(dataset_id: str, photo_id: str):
         traceback.print_exc()
         return Response(status_code=500)
 
+#removes many photos from a given dataset in one request, body is a list of photo ids
+@app.post("/dataset/photos/remove")
+async def remove_photos_from_dataset(dataset_id: str, photo_ids: List[str]):
+    try:
+        removed, not_found = await async_db.remove_photos_from_dataset(dataset_id, photo_ids)
+        return {"removed": removed, "not_found": not_found}
+    except Exception as e:
+        print("Exception occurred:", e)
+        traceback.print_exc()
+        return Response(status_code=500)
+
 #returns true or false depending if the name as been used for a given dataset
 @app.get("/dataset/name")
 async def dataset_name_exists(name: str):
-    return {"name_exists": db.dataset_name_exists(name)}
+    return {"name_exists": await async_db.dataset_name_exists(name)}
 
 
 #returns the id belonging to the dataset provided 
 @app.get("/dataset/id")
 async def dataset_get_id(name: str):
-    dataset = db.get_dataset_from_name(name)
+    dataset = await async_db.get_dataset_from_name(name)
     return {"id": dataset["_id"]}
 
     
@@ -89,52 +203,172 @@ async def dataset_get_id(name: str):
 @app.get("/datasets/names")
 async def get_dataset_names():
 
-    names = db.get_all_dataset_names()
+    names = await async_db.get_all_dataset_names()
     return {"names" : names}
 
-#returns all dataset metadata
+#returns all dataset metadata, including the photo ids of every split
+#fields limits the fields returned (comma separated), leave out the <split>_photos fields to skip the photo ids
+#stream returns newline delimited JSON, the metadata on the first line then a {"split", "photo_id"} line per photo,
+#use /dataset/photos/ids to page through the photo ids instead
 @app.get("/dataset/metadata")
-async def get_dataset(dataset_id: str):
+async def get_dataset(dataset_id: str, fields: Optional[str] = None, stream: bool = False):
+    fields = parse_fields(fields)
+    if stream:
+        photo_fields = [f"{split}_photos" for split in db.SPLITS]
+        splits = [split for split in db.SPLITS if fields is None or f"{split}_photos" in fields]
+        if fields is not None:
+            fields = [field for field in fields if field not in photo_fields]
+
+        def lines():
+            yield db.get_dataset_metadata(dataset_id, fields)
+            for split, photo_id in db.iter_dataset_photos(dataset_id, splits):
+                yield {"split": split, "photo_id": photo_id}
+        return ndjson_response(lines())
     try: 
-        return db.get_dataset_from_id(dataset_id)
+        return await async_db.get_dataset_with_photos(dataset_id, fields)
     except Exception as e:
         print("Exception occurred:", e)
         traceback.print_exc()
         return Response(status_code=500)
 
-#loads dataset into the working DIR
+#returns one page of the photo ids in a split of a dataset, pass the returned next_after to get the next page
+@app.get("/dataset/photos/ids")
+async def get_dataset_photo_ids(dataset_id: str, split: str, after: Optional[str] = None,
+                                limit: int = Query(1000, ge=1, le=MAX_PAGE_SIZE)):
+    if split not in db.SPLITS:
+        raise HTTPException(status_code=400, detail=f"Unknown split {split}")
+    photo_ids = await async_db.get_dataset_photo_page(dataset_id, split, after, limit)
+    next_after = photo_ids[-1] if len(photo_ids) == limit else None
+    return {"photo_ids": photo_ids, "next_after": next_after}
+
+#streams a dataset as a tar archive of images, YOLO labels and data.yaml for IPS nodes on other machines,
+#supports Range requests (with If-Range against the ETag) so interrupted downloads can resume
+@app.get("/dataset/download")
+async def download_dataset(dataset_id: str, request: Request):
+    plan = await run_in_threadpool(dataset_stream.get_plan, dataset_id)
+    if plan is None:
+        raise HTTPException(status_code=404, detail="Dataset not found")
+    size = plan["size"]
+
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": plan["etag"],
+        "Content-Disposition": f'attachment; filename="{dataset_id}.tar"'
+    }
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if if_range is not None and if_range != plan["etag"]:
+        # the dataset changed since the partial download, start again from the beginning
+        range_header = None
+
+    try:
+        byte_range = dataset_stream.parse_range(range_header, size)
+    except ValueError:
+        return Response(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+
+    status_code = 200
+    start, end = 0, size - 1
+    if byte_range is not None:
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+
+    return StreamingResponse(
+        dataset_stream.iter_archive(plan, start, end),
+        status_code=status_code,
+        media_type="application/x-tar",
+        headers=headers
+    )
+
+#loads dataset into the working DIR, returns the job directory holding its data.yaml
+#format "shards" exports it as shard files instead of a folder of links and label files
+#resolution uses the resized variants of the images instead of the originals
 @app.get ("/dataset")
-async def load_dataset(dataset_id: str):
-    dataset_handler.load_dataset(dataset_id)
+async def load_dataset(dataset_id: str, format: str = "tree", resolution: Optional[int] = None):
+    check_load_options(format, resolution)
+    # runs on the dataset job pool so the event loop is not blocked
+    _, future = dataset_handler.start_load_job(dataset_id, with_labels=True, export_format=format, resolution=resolution)
+    return await asyncio.wrap_future(future)
+
+#starts loading a dataset in the background, returns the job id to poll
+@app.post("/dataset/jobs")
+async def start_dataset_job(dataset_id: str, with_labels: bool = True, format: str = "tree", resolution: Optional[int] = None):
+    check_load_options(format, resolution)
+    job_id, _ = dataset_handler.start_load_job(dataset_id, with_labels, format, resolution)
+    return {"job_id": job_id}
+
+#returns the status and progress of a background dataset job, the load result once done
+@app.get("/dataset/jobs")
+async def get_dataset_job(job_id: str):
+    job = background_jobs.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
+#cancels a queued or running background dataset job
+@app.post("/dataset/jobs/cancel")
+async def cancel_dataset_job(job_id: str):
+    if not background_jobs.cancel_job(job_id):
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return Response(status_code=200)
+
+#removes the job directory of a finished dataset load so its cached dataset can be evicted
+@app.delete("/dataset/job")
+async def release_dataset_job(job_id: str):
+    # a snapshot holds a link per image, removing it is slow enough to block the event loop
+    if not await run_in_threadpool(job_dirs.remove_job_dir, job_id):
+        raise HTTPException(status_code=404, detail="Job not found")
+    return Response(status_code=200)
  
 
 ######################## Annotation Requests ########################
 
-#adds annotations to the dataset
+#adds annotations to the dataset, replacing the photo's earlier annotation for the same class set
 @app.post("/annotations")
 async def add_annotations(payload :dict):
     
     try:   
 
-        success = db.save_annotations(payload)
+        success = await async_db.save_annotations(payload)
         
         if success:
             return Response(status_code=200)
         else:
             return Response(status_code=500)
+    except annotation_codec.InvalidAnnotationError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid annotation: {e}")
+    except Exception as e:
+        print("Exception occurred:", e)
+        traceback.print_exc()
+        return Response(status_code=500)
+
+#adds many annotations in one request, body is a list of annotation documents as taken by /annotations
+#an annotation replaces the photo's earlier annotation for the same class set, returns a result per annotation
+@app.post("/annotations/bulk")
+async def add_annotations_bulk(payload: List[dict]):
+    try:
+        results = await async_db.save_annotations_bulk(payload)
+        return {"results": results}
     except Exception as e:
         print("Exception occurred:", e)
         traceback.print_exc()
         return Response(status_code=500)
 
 
-# gets all annotations for a given photo
+# gets all annotations for a given photo, oldest first
+# fields limits the fields returned (comma separated), after and limit page through them with the returned next_after,
+# stream returns every annotation as newline delimited JSON instead
 @app.get("/annotations/photo")
-async def  get_annotations(photo_id: str):
+async def  get_annotations(photo_id: str, fields: Optional[str] = None, after: Optional[str] = None,
+                           limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), stream: bool = False):
+    fields = parse_fields(fields)
+    if stream:
+        return ndjson_response(db.get_annotations_for_photo(photo_id, fields, after))
     try:
        
-        annotations = list(db.get_annotations_for_photo(photo_id))
-        return {"annotations": annotations }
+        annotations = await async_db.get_annotations_for_photo(photo_id, fields, after, limit)
+        return page_response("annotations", annotations, limit)
     except Exception as e:
         print("Exception occurred:", e)
         traceback.print_exc()
@@ -143,12 +377,18 @@ async def  get_annotations(photo_id: str):
 ######################## Model Requests ########################
 
 #gets all models
+# fields limits the fields returned (comma separated), after and limit page through them with the returned next_after,
+# stream returns every model as newline delimited JSON instead
 @app.get("/models")
-async def get_all_models():
+async def get_all_models(fields: Optional[str] = None, after: Optional[str] = None,
+                         limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE), stream: bool = False):
+    fields = parse_fields(fields)
+    if stream:
+        return ndjson_response(db.get_all_models(fields, after))
     try:
-       models = db.get_all_models()
+       models = await async_db.get_all_models(fields, after, limit)
 
-       return {"models" : models}
+       return page_response("models", models, limit)
         
     except Exception as e:
         print("Exception occurred:", e)
@@ -161,7 +401,7 @@ async def get_model_path(model_name:str):
 
     try:
        
-        model_path = db.get_model_path(model_name)
+        model_path = await async_db.get_model_path(model_name)
         return {"file_path" : model_path}
        
     except Exception as e:
@@ -174,7 +414,7 @@ async def get_model_path(model_name:str):
 async def model_name_exists(model_name:str):
     try:
        
-       model_name_exists = db.model_name_exists(model_name)
+       model_name_exists = await async_db.model_name_exists(model_name)
        return {"name_exists" : model_name_exists}
 
        
@@ -189,18 +429,55 @@ async def upload_model_file(model_id: str = Form(...),file: UploadFile = File(..
     try:
         await  model_handler.upload_model(file,model_id)
 
+    except model_handler.UploadSessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         print(e)
         raise HTTPException(status_code=500, detail=f"Upload failed: {e}")
 
 
+#starts a resumable upload of model weights, returns the upload id
+@app.post("/models/uploads")
+async def start_model_upload(model_id: str, total_size: Optional[int] = None):
+    try:
+        return await model_handler.start_upload(model_id, total_size)
+    except model_handler.UploadSessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+#returns the number of bytes received for a resumable upload, where the client should resume from
+@app.get("/models/uploads")
+async def get_model_upload(upload_id: str):
+    try:
+        return await model_handler.get_upload(upload_id)
+    except model_handler.UploadSessionError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+#appends a chunk of model weights at the given offset
+@app.put("/models/uploads")
+async def upload_model_chunk(upload_id: str = Form(...), offset: int = Form(...), file: UploadFile = File(...)):
+    try:
+        return await model_handler.upload_chunk(upload_id, offset, file)
+    except model_handler.UploadSessionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+#verifies the checksum of a resumable upload and saves the model weights path
+@app.post("/models/uploads/finalize")
+async def finalize_model_upload(upload_id: str, sha256: str):
+    try:
+        path = await model_handler.finalize_upload(upload_id, sha256)
+        return {"file_path": path}
+    except model_handler.UploadSessionError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except Exception as e:
+        print(e)
+        raise HTTPException(status_code=500, detail=f"Upload failed: {e}")
 
 @app.post("/models")
 async def upload_model_data(model_data: dict):
    
     try:
 
-        model_id = db.save_model(model_data)
+        model_id = await async_db.save_model(model_data)
         return {"id": model_id}
        
     except Exception as e:
@@ -210,6 +487,36 @@ async def upload_model_data(model_data: dict):
 
 
 
+######################## Debug Requests ########################
+
+# explains a dynamic_find filter (same syntax as dataset creation) to confirm it hits an index
+@app.post("/debug/explain")
+async def explain_query(filters: dict, collection: str = "trees"):
+    if collection not in db.COLLECTIONS:
+        raise HTTPException(status_code=400, detail=f"Unknown collection {collection}")
+    try:
+        return await async_db.explain_find(collection, filters.get("exact", {}), filters.get("range", {}), filters.get("geo", {}))
+    except Exception as e:
+        print("Exception occurred:", e)
+        traceback.print_exc()
+        return Response(status_code=500)
+
+# lists the indexes of every collection
+@app.get("/debug/indexes")
+async def list_indexes():
+    return await async_db.get_index_names()
+
+# metrics in the Prometheus text format: request latencies, MongoDB command timings, dataset load stages and ingest counts
+@app.get("/metrics")
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# hit and miss counts of the dataset and model lookup cache
+@app.get("/debug/cache")
+async def lookup_cache_stats():
+    return db.lookup_cache.stats()
+
+
 # start the server 
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,143 @@
+import errno
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from config import MATERIALIZE_MODE, MATERIALIZE_WORKERS
+
+#this file handles placing image files into a folder in bulk, either by linking or copying them
+
+# supported ways of placing a file in the destination folder
+MATERIALIZE_MODES = ("symlink", "hardlink", "reflink", "copy")
+# mode used to snapshot an already materialized folder, see _snapshot
+SNAPSHOT_MODE = "snapshot"
+
+# linux ioctl request for cloning a file's extents (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# errors meaning the file system cannot reflink, in which case a full copy is made
+REFLINK_UNSUPPORTED = {errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL, errno.ENOTTY, errno.EPERM}
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+# returns the pool shared by every materialization, created on first use
+# return: ThreadPoolExecutor
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MATERIALIZE_WORKERS, thread_name_prefix="materialize")
+        return _executor
+
+
+# places every file in src_paths into dest_dir, keeping the file names
+# param: src_paths: list of paths to the source files
+# param: dest_dir: folder the files are placed in, must already exist
+# param: mode: one of MATERIALIZE_MODES, or SNAPSHOT_MODE
+# param: progress_callback: optional function called with (files_done, total_files)
+# return: list of (src_path, error message) for each file that failed
+def materialize_files(src_paths, dest_dir, mode=MATERIALIZE_MODE, progress_callback=None):
+
+    if mode not in PLACE_FILE:
+        raise ValueError(f"Unknown materialize mode {mode}, expected one of {MATERIALIZE_MODES}")
+    place_file = PLACE_FILE[mode]
+
+    executor = get_executor()
+    # bound the number of queued futures so huge splits do not build huge queues
+    max_in_flight = MATERIALIZE_WORKERS * 4
+
+    total = len(src_paths)
+    done = 0
+    errors = []
+    pending = set()
+
+    def collect(finished):
+        nonlocal done
+        for future in finished:
+            src_path, error = future.result()
+            if error is not None:
+                errors.append((src_path, error))
+            done += 1
+            if progress_callback is not None:
+                progress_callback(done, total)
+
+    for src_path in src_paths:
+        dest_path = os.path.join(dest_dir, os.path.basename(src_path))
+        pending.add(executor.submit(_place_safely, place_file, src_path, dest_path))
+
+        if len(pending) >= max_in_flight:
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            collect(finished)
+
+    finished, _ = wait(pending)
+    collect(finished)
+
+    return errors
+
+
+# runs place_file catching any error so one bad file does not stop the split
+# return: (src_path, error message or None)
+def _place_safely(place_file, src_path, dest_path):
+    try:
+        place_file(src_path, dest_path)
+        return src_path, None
+    except OSError as e:
+        return src_path, e.strerror or str(e)
+
+
+def _symlink(src_path, dest_path):
+    if not os.path.isfile(src_path):
+        raise FileNotFoundError(errno.ENOENT, "Source file missing", src_path)
+    os.symlink(src_path, dest_path)
+
+
+def _hardlink(src_path, dest_path):
+    os.link(src_path, dest_path)
+
+
+def _copy(src_path, dest_path):
+    shutil.copyfile(src_path, dest_path)
+
+
+# clones the file where the file system supports it, otherwise falls back to a full copy
+def _reflink(src_path, dest_path):
+    try:
+        import fcntl
+    except ImportError:
+        # not available on windows
+        _copy(src_path, dest_path)
+        return
+
+    with open(src_path, "rb") as src, open(dest_path, "wb") as dest:
+        try:
+            fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+            return
+        except OSError as e:
+            if e.errno not in REFLINK_UNSUPPORTED:
+                raise
+        shutil.copyfileobj(src, dest)
+
+
+# places a file of a materialized folder so it no longer changes with that folder: symlinks are recreated
+# pointing at the same target, other files are hardlinked, or copied where hardlinks are not supported
+def _snapshot(src_path, dest_path):
+    if os.path.islink(src_path):
+        os.symlink(os.readlink(src_path), dest_path)
+        return
+    try:
+        os.link(src_path, dest_path)
+    except OSError as e:
+        if e.errno not in REFLINK_UNSUPPORTED and e.errno != errno.EMLINK:
+            raise
+        _copy(src_path, dest_path)
+
+
+PLACE_FILE = {
+    "symlink": _symlink,
+    "hardlink": _hardlink,
+    "reflink": _reflink,
+    "copy": _copy,
+    SNAPSHOT_MODE: _snapshot,
+}
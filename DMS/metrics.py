@@ -0,0 +1,144 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from pymongo import monitoring
+
+#this file collects in-process metrics and renders them in the Prometheus text format for GET /metrics.
+#recording a value is a dict lookup and an addition under a lock, cheap enough to leave on everywhere
+
+# upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry = []
+
+
+# a value that only goes up, e.g. bytes ingested
+class Counter:
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    # param: amount: amount to add
+    # param: labels: a value for each label name
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+# a distribution of observed values, e.g. request latencies
+class Histogram:
+
+    def __init__(self, name, description, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(buckets)
+        # label values to [count per bucket (last is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    # param: value: observed value, seconds for latencies
+    # param: labels: a value for each label name
+    def observe(self, value, **labels):
+        key = tuple(labels.get(name, "") for name in self.label_names)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    # times the body of a with block
+    # param: labels: a value for each label name
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (bucket_counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ("+Inf",), bucket_counts):
+                    cumulative += bucket_count
+                    labels = format_labels(self.label_names + ("le",), key + (str(bound),))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = format_labels(self.label_names, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+# renders every metric
+# return: Prometheus text exposition format
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+######################## Metrics ########################
+
+REQUEST_SECONDS = Histogram(
+    "dms_http_request_duration_seconds", "Time to handle an API request", ("method", "route", "status")
+)
+MONGO_COMMAND_SECONDS = Histogram(
+    "dms_mongo_command_duration_seconds", "Time MongoDB took to answer a command", ("command", "outcome")
+)
+DATASET_STAGE_SECONDS = Histogram(
+    "dms_dataset_load_stage_duration_seconds", "Time spent in each stage of loading a dataset", ("stage",)
+)
+DATASET_FILES = Counter(
+    "dms_dataset_files_total", "Files placed or removed in cached datasets", ("kind", "action")
+)
+INGEST_FILES = Counter(
+    "dms_ingest_files_total", "Images received by status (ok, duplicate, error)", ("status",)
+)
+INGEST_BYTES = Counter(
+    "dms_ingest_bytes_total", "Bytes of images written to the image store"
+)
+
+
+# records the duration of every command the MongoDB client sends, registered on the client in db.py
+class MongoCommandListener(monitoring.CommandListener):
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name, outcome="ok")
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, command=event.command_name, outcome="error")
@@ -0,0 +1,52 @@
+import argparse
+import db
+
+#one off migrations of existing data to newer document layouts
+#usage: python migrate.py <migration>
+
+
+# adds the GeoJSON location point used by geo filters to images stored before it existed
+def migrate_locations():
+    print(f"Added location to {db.backfill_locations()} images")
+    db.ensure_indexes()
+
+
+# moves dataset photo arrays out of the dataset documents into the membership collection
+def migrate_membership():
+    db.ensure_indexes()
+    for dataset_id in db.get_unmigrated_dataset_ids():
+        photo_counts = db.migrate_dataset_membership(dataset_id)
+        print(f"Migrated dataset {dataset_id}: {photo_counts}")
+
+
+# converts annotations stored as YOLO text lines into packed boxes
+def migrate_annotations():
+    converted, invalid = db.migrate_annotation_encoding()
+    print(f"Converted {converted} annotations")
+    for annotation_id, error in invalid:
+        print(f"Left annotation {annotation_id} as text lines: {error}")
+
+
+# keys annotations by photo and class set, deleting older annotations of the same photo and class set
+def migrate_annotation_keys():
+    # the unique index must exist first, it is what rejects keying an older duplicate so it gets deleted instead.
+    # it only covers keyed annotations so it builds on unmigrated data
+    db.ensure_indexes()
+    keyed, deleted = db.migrate_annotation_keys()
+    print(f"Keyed {keyed} annotations, deleted {deleted} older duplicates")
+
+
+MIGRATIONS = {
+    "annotation-keys": migrate_annotation_keys,
+    "annotations": migrate_annotations,
+    "locations": migrate_locations,
+    "membership": migrate_membership,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate existing DMS data")
+    parser.add_argument("migration", choices=sorted(MIGRATIONS))
+    args = parser.parse_args()
+
+    MIGRATIONS[args.migration]()
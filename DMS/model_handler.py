@@ -1,17 +1,175 @@
 import os
-from config import BASE_MODEL_DIR
+import json
+import threading
+import time
+from fastapi.concurrency import run_in_threadpool
+from config import BASE_MODEL_DIR, UPLOAD_CHUNK_SIZE, UPLOAD_SESSION_TTL_SECONDS
+import async_db
 import db
+import utils
+
+# folder holding in progress resumable uploads, each has a .part file and a .json session file
+UPLOAD_SESSION_DIR = os.path.join(BASE_MODEL_DIR, "uploads")
+
+_session_locks = {}
+_session_locks_lock = threading.Lock()
+
+
+# raised when a resumable upload request does not match the state of its session
+class UploadSessionError(Exception):
+    pass
+
 
 # Saves model weights to DMS
-# param: file: model weights 
-# model_id: id for model 
+# the weights are streamed to disk in chunks off the event loop
+# param: file: model weights
+# model_id: id for model
 async def upload_model(file, model_id):
 
-    contents = await file.read()
-
+    # checked first so weights for an unknown model are never written
+    if not await async_db.model_exists(model_id):
+        raise UploadSessionError(f"No model with id {model_id}")
 
     save_path = os.path.join(BASE_MODEL_DIR,model_id+".pt")
-    with open(save_path, "wb") as f:
-        f.write(contents)
-    
-    db.save_model_path(model_id,save_path)
\ No newline at end of file
+    checksum, size = await run_in_threadpool(utils.stream_to_file, file.file, save_path, UPLOAD_CHUNK_SIZE)
+
+    await async_db.save_model_path(model_id,save_path, checksum, size)
+
+
+######################## Resumable Uploads ########################
+
+# starts a resumable upload of model weights
+# param: model_id: id for model
+# param: total_size: optional expected size of the weights in bytes
+# return: session dict with the upload id and current offset
+async def start_upload(model_id, total_size=None):
+    await run_in_threadpool(cleanup_sessions)
+    if not await async_db.model_exists(model_id):
+        raise UploadSessionError(f"No model with id {model_id}")
+
+    upload_id = db.generate_id()
+    session = {"upload_id": upload_id, "model_id": model_id, "total_size": total_size}
+    await run_in_threadpool(create_session, session)
+    session["offset"] = 0
+    return session
+
+# returns the state of a resumable upload so a dropped client knows where to resume from
+# param: upload_id: id of the upload
+# return: session dict with the current offset
+async def get_upload(upload_id):
+    return await run_in_threadpool(read_session, upload_id)
+
+# appends a chunk to a resumable upload
+# param: upload_id: id of the upload
+# param: offset: byte offset the chunk starts at, must equal the bytes received so far
+# param: file: the chunk
+# return: session dict with the new offset
+async def upload_chunk(upload_id, offset, file):
+    return await run_in_threadpool(append_chunk, upload_id, offset, file.file)
+
+# completes a resumable upload, verifying its checksum before moving it into place and saving its path
+# param: upload_id: id of the upload
+# param: sha256: hex digest of the whole weights file as computed by the client
+# return: path the weights were saved to
+async def finalize_upload(upload_id, sha256):
+    return await run_in_threadpool(finalize_session, upload_id, sha256)
+
+
+def create_session(session):
+    os.makedirs(UPLOAD_SESSION_DIR, exist_ok=True)
+    with open(session_path(session["upload_id"], ".json"), "w") as f:
+        json.dump(session, f)
+    open(session_path(session["upload_id"], ".part"), "wb").close()
+
+def read_session(upload_id):
+    try:
+        with open(session_path(upload_id, ".json")) as f:
+            session = json.load(f)
+    except FileNotFoundError:
+        raise UploadSessionError(f"Unknown upload {upload_id}")
+    session["offset"] = os.path.getsize(session_path(upload_id, ".part"))
+    return session
+
+def append_chunk(upload_id, offset, src):
+    with get_session_lock(upload_id):
+        session = read_session(upload_id)
+        if offset != session["offset"]:
+            raise UploadSessionError(f"Chunk offset {offset} does not match received offset {session['offset']}")
+
+        part_path = session_path(upload_id, ".part")
+        with open(part_path, "ab") as f:
+            while True:
+                chunk = src.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                f.write(chunk)
+
+        session["offset"] = os.path.getsize(part_path)
+        if session["total_size"] is not None and session["offset"] > session["total_size"]:
+            # drop the chunk so the client can resend it correctly
+            os.truncate(part_path, offset)
+            raise UploadSessionError(f"Upload exceeds its total size of {session['total_size']} bytes")
+        return session
+
+def finalize_session(upload_id, sha256):
+    with get_session_lock(upload_id):
+        session = read_session(upload_id)
+        if session["total_size"] is not None and session["offset"] != session["total_size"]:
+            raise UploadSessionError(f"Upload incomplete, {session['offset']} of {session['total_size']} bytes received")
+
+        part_path = session_path(upload_id, ".part")
+        checksum = utils.hash_file(part_path, UPLOAD_CHUNK_SIZE)
+        if checksum != sha256.lower():
+            raise UploadSessionError(f"Checksum mismatch, expected {sha256} but received data hashes to {checksum}")
+
+        # the model may have been removed since the upload started, nothing is moved for a missing model
+        if not db.model_exists(session["model_id"]):
+            raise UploadSessionError(f"No model with id {session['model_id']}")
+
+        save_path = os.path.join(BASE_MODEL_DIR, session["model_id"]+".pt")
+        os.replace(part_path, save_path)
+        os.remove(session_path(upload_id, ".json"))
+    with _session_locks_lock:
+        _session_locks.pop(upload_id, None)
+
+    # only set once the weights are completely in place
+    db.save_model_path(session["model_id"], save_path, checksum, session["offset"])
+    return save_path
+
+# removes uploads that have received no chunk for UPLOAD_SESSION_TTL_SECONDS, along with their partial files
+def cleanup_sessions():
+    if not os.path.isdir(UPLOAD_SESSION_DIR):
+        return
+    expired_before = time.time() - UPLOAD_SESSION_TTL_SECONDS
+    for name in os.listdir(UPLOAD_SESSION_DIR):
+        upload_id, extension = os.path.splitext(name)
+        if extension != ".json":
+            continue
+        lock = get_session_lock(upload_id)
+        # an upload busy receiving a chunk or finalizing is in use
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            last_used = max(
+                (os.path.getmtime(session_path(upload_id, ext)) for ext in (".json", ".part")
+                 if os.path.exists(session_path(upload_id, ext))),
+                default=0
+            )
+            if last_used < expired_before:
+                for ext in (".json", ".part"):
+                    try:
+                        os.remove(session_path(upload_id, ext))
+                    except FileNotFoundError:
+                        pass
+                with _session_locks_lock:
+                    _session_locks.pop(upload_id, None)
+                print(f"Removed abandoned upload {upload_id}")
+        finally:
+            lock.release()
+
+def session_path(upload_id, extension):
+    return os.path.join(UPLOAD_SESSION_DIR, os.path.basename(upload_id)+extension)
+
+def get_session_lock(upload_id):
+    with _session_locks_lock:
+        return _session_locks.setdefault(upload_id, threading.Lock())
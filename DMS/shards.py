@@ -0,0 +1,207 @@
+import bisect
+import json
+import mmap
+import os
+import shutil
+import struct
+from config import SHARD_SIZE_BYTES, ID_QUERY_CHUNK_SIZE
+import db
+import image_tiers
+
+#this file writes loaded datasets as a few large shard files per split instead of a tree of links and tiny label files,
+#and reads single photos back out of them without extracting.
+#
+#shard layout:
+#   MAGIC
+#   image and label bytes, back to back in photo id order
+#   index: one INDEX_RECORD per photo, sorted by photo id
+#   footer: index offset (u64), record count (u64), MAGIC
+#the index uses fixed size records so it can be binary searched straight from a memory map
+
+MAGIC = b"DMSSHRD1"
+INDEX_RECORD = struct.Struct("<32sQQQI8s")  # photo id, image offset, image length, label offset, label length, extension
+FOOTER = struct.Struct("<QQ8s")
+MANIFEST_NAME = "shards.json"
+
+
+# writes every split of a dataset into shard files
+# param: dataset: dataset document
+# param: out_dir: folder the shards and their manifest are written to
+# param: progress_callback: optional function called with (stage, done, total)
+# param: resolution: optional image variant resolution to shard instead of the originals
+# return: path to the manifest listing the shards of each split
+def write_dataset_shards(dataset, out_dir, progress_callback=None, resolution=None):
+    os.makedirs(out_dir, exist_ok=True)
+    classes = dataset.get("classes", [])
+    manifest = {"dataset_id": dataset["_id"], "classes": classes, "resolution": resolution, "splits": {}}
+
+    for split in db.SPLITS:
+        photo_ids = sorted(db.get_dataset_photo_ids(dataset, split))
+        writer = None
+        shard_names = []
+        errors = []
+
+        for start in range(0, len(photo_ids), ID_QUERY_CHUNK_SIZE):
+            chunk = photo_ids[start:start + ID_QUERY_CHUNK_SIZE]
+            # the paths are looked up and read in one go so cold images are not moved to the archive in between
+            with image_tiers.loading():
+                paths = db.get_photo_paths(chunk, resolution)
+                labels = db.get_annotations_for_photos(chunk, classes)
+
+                for i, photo_id in enumerate(chunk, start=start + 1):
+                    path = paths.get(photo_id)
+                    if path is None:
+                        errors.append((photo_id, "No image metadata"))
+                        continue
+
+                    if writer is None or writer.size >= SHARD_SIZE_BYTES:
+                        if writer is not None:
+                            writer.close()
+                        shard_name = f"{split}-{len(shard_names):05d}.shard"
+                        shard_names.append(shard_name)
+                        writer = ShardWriter(os.path.join(out_dir, shard_name))
+
+                    try:
+                        writer.add(photo_id, path, labels.get(photo_id, ""))
+                    except OSError as e:
+                        errors.append((photo_id, e.strerror or str(e)))
+
+                    if progress_callback is not None:
+                        progress_callback(f"shards/{split}", i, len(photo_ids))
+
+        if writer is not None:
+            writer.close()
+        for photo_id, error in errors:
+            print(f"Failed to shard {photo_id}: {error}")
+        manifest["splits"][split] = shard_names
+
+    manifest_path = os.path.join(out_dir, MANIFEST_NAME)
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f)
+    return manifest_path
+
+
+# writes one shard file, photos must be added in photo id order
+class ShardWriter:
+
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = path + ".part"
+        self.file = open(self.temp_path, "wb")
+        self.file.write(MAGIC)
+        self.size = len(MAGIC)
+        self.records = []
+
+    # appends a photo and its label text to the shard
+    # param: photo_id: id of photo
+    # param: image_path: path of the image file
+    # param: label_text: YOLO label file text, empty if the photo has no annotation
+    def add(self, photo_id, image_path, label_text):
+        image_offset = self.size
+        try:
+            with open(image_path, "rb") as image:
+                shutil.copyfileobj(image, self.file)
+        except OSError:
+            # drop whatever part of the image was copied so the next photo starts at the right offset
+            self.file.seek(image_offset)
+            self.file.truncate()
+            raise
+        image_length = self.file.tell() - image_offset
+
+        label = label_text.encode()
+        self.file.write(label)
+        extension = os.path.splitext(image_path)[1].lstrip(".")
+
+        self.records.append(INDEX_RECORD.pack(
+            photo_id.encode(), image_offset, image_length, image_offset + image_length, len(label), extension.encode()
+        ))
+        self.size = self.file.tell()
+
+    # writes the index and footer, then moves the shard into place
+    def close(self):
+        index_offset = self.size
+        for record in self.records:
+            self.file.write(record)
+        self.file.write(FOOTER.pack(index_offset, len(self.records), MAGIC))
+        self.file.close()
+        os.replace(self.temp_path, self.path)
+
+
+# random access to the photos of one shard by photo id through a memory map
+class ShardReader:
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, self.count, magic = FOOTER.unpack_from(self.map, len(self.map) - FOOTER.size)
+        if magic != MAGIC or self.map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a shard file")
+        self.index_offset = index_offset
+
+    # returns the id of the n'th photo in the shard
+    def photo_id_at(self, n):
+        record = INDEX_RECORD.unpack_from(self.map, self.index_offset + n * INDEX_RECORD.size)
+        return record[0].rstrip(b"\0").decode()
+
+    # all photo ids in the shard, in order
+    def photo_ids(self):
+        return [self.photo_id_at(n) for n in range(self.count)]
+
+    # looks up a photo
+    # param: photo_id: id of photo
+    # return: (image bytes, label text, image extension), None if the photo is not in the shard
+    def get(self, photo_id):
+        n = bisect.bisect_left(_IndexView(self), photo_id)
+        if n == self.count or self.photo_id_at(n) != photo_id:
+            return None
+        _, image_offset, image_length, label_offset, label_length, extension = INDEX_RECORD.unpack_from(
+            self.map, self.index_offset + n * INDEX_RECORD.size
+        )
+        image = self.map[image_offset:image_offset + image_length]
+        label = self.map[label_offset:label_offset + label_length].decode()
+        return image, label, extension.rstrip(b"\0").decode()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+# random access to the photos of an exported dataset across all of its shards
+class DatasetShards:
+
+    def __init__(self, out_dir):
+        with open(os.path.join(out_dir, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        self.readers = {
+            split: [ShardReader(os.path.join(out_dir, name)) for name in names]
+            for split, names in self.manifest["splits"].items()
+        }
+
+    # looks up a photo in any split
+    # param: photo_id: id of photo
+    # return: (split, image bytes, label text, image extension), None if the photo is not in the dataset
+    def get(self, photo_id):
+        for split, readers in self.readers.items():
+            for reader in readers:
+                entry = reader.get(photo_id)
+                if entry is not None:
+                    return (split,) + entry
+        return None
+
+    def close(self):
+        for readers in self.readers.values():
+            for reader in readers:
+                reader.close()
+
+
+# sequence view over a shard's sorted photo ids so bisect can search the memory mapped index
+class _IndexView:
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __len__(self):
+        return self.reader.count
+
+    def __getitem__(self, n):
+        return self.reader.photo_id_at(n)
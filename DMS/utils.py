@@ -1,3 +1,58 @@
+import hashlib
+import os
+
+
 #checks a given file is an image file
 def is_image_file(file_path):
     return file_path.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp'))
+
+# copies a file object to disk in fixed size chunks, hashing it as it goes,
+# the data is written to a temp file that is renamed into place once complete
+# blocking, so call off the event loop
+# param: src: readable binary file object e.g. UploadFile.file
+# param: dest_path: final path of the file
+# param: chunk_size: bytes read per chunk
+# return: (sha256 hex digest, size in bytes)
+def stream_to_file(src, dest_path, chunk_size):
+    temp_path = dest_path + ".part"
+    checksum, size = stream_to_temp_file(src, temp_path, chunk_size)
+    os.replace(temp_path, dest_path)
+    return checksum, size
+
+# copies a file object to a temp file in fixed size chunks, hashing it as it goes,
+# the caller decides whether to rename the temp file into place or remove it
+# param: src: readable binary file object
+# param: temp_path: path of the temp file, removed again if the copy fails
+# param: chunk_size: bytes read per chunk
+# return: (sha256 hex digest, size in bytes)
+def stream_to_temp_file(src, temp_path, chunk_size):
+    checksum = hashlib.sha256()
+    size = 0
+    try:
+        with open(temp_path, "wb") as f:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                checksum.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return checksum.hexdigest(), size
+
+# hashes a file on disk in fixed size chunks
+# param: file_path: path of the file
+# param: chunk_size: bytes read per chunk
+# return: sha256 hex digest
+def hash_file(file_path, chunk_size):
+    checksum = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            checksum.update(chunk)
+    return checksum.hexdigest()